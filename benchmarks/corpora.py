@@ -0,0 +1,140 @@
+"""
+Synthetic dockerfiles for the benchmarks
+
+Everything is generated from a fixed seed so runs can be compared.
+"""
+import random
+
+PACKAGES = ['git', 'wget', 'curl', 'cmake', 'build-essential', 'libatlas-base-dev', 'libboost-all-dev',
+            'libopencv-dev', 'libprotobuf-dev', 'libgoogle-glog-dev', 'libhdf5-dev', 'python3-dev',
+            'python3-pip', 'python3-numpy', 'gfortran', 'vim', 'unzip', 'ca-certificates']
+
+
+def small():
+    """
+    A typical dockerfile
+    """
+    return """# A typical image
+FROM nvidia/cuda:8.0-cudnn5-devel
+MAINTAINER Someone <someone@example.com>
+ARG VERSION=1.0
+ENV LANG=C.UTF-8 LC_ALL=C.UTF-8
+
+RUN apt-get update && apt-get install -y \\
+  {packages} && \\
+  rm -rf /var/lib/apt/lists/*
+
+# Get the code
+RUN git clone https://github.com/BVLC/caffe.git /root/caffe && \\
+  cd /root/caffe && git checkout $VERSION
+ENV PYTHONPATH=/root/caffe/python:$PYTHONPATH
+LABEL maintainer=someone version=1.0
+EXPOSE 8888
+WORKDIR /root/caffe
+ENTRYPOINT ["/bin/bash", "-c"]
+CMD ["python3", "train.py"]
+""".format(packages=' \\\n  '.join(PACKAGES))
+
+
+def huge(instructions=5000, seed=0):
+    """
+    A dockerfile with a lot of short instructions
+    """
+    rng = random.Random(seed)
+    lines = ['FROM ubuntu:16.04']
+    for i in range(instructions):
+        kind = rng.choice(['RUN', 'RUN', 'RUN', 'ENV', 'LABEL', '#'])
+        if kind == 'RUN':
+            lines.append('RUN echo {i} && apt-get install -y {package}'.format(i=i, package=rng.choice(PACKAGES)))
+        elif kind == '#':
+            lines.append('# step {i}'.format(i=i))
+        else:
+            lines.append('{kind} KEY_{i}=value_{i}'.format(kind=kind, i=i))
+    return '\n'.join(lines) + '\n'
+
+
+def continuation_heavy(lines=20000, seed=0):
+    """
+    One RUN with a very long continuation block, with comments mixed in
+    """
+    rng = random.Random(seed)
+    body = []
+    for i in range(lines):
+        if i % 50 == 0:
+            body.append('# install group {i}'.format(i=i))
+        body.append('  {package} \\'.format(package=rng.choice(PACKAGES)))
+    return 'FROM ubuntu:16.04\nRUN apt-get update && apt-get install -y \\\n' + '\n'.join(body) + '\n  vim\n'
+
+
+def adversarial(lines=20000):
+    """
+    Input that is hard on regex based parsers: long continuation blocks that
+    almost match and then end in a character they don't expect, over and over
+    """
+    block = 'RUN ' + 'a  b \\\n  ' * 30 + 'é\x01\n'
+    blocks = 'FROM ubuntu:16.04\n' + block * (lines // 31)
+    # Trailing continuation with no end and no final newline
+    return blocks + 'RUN ' + 'x \\\n' * 100 + '\\'
+
+
+def env_list(pairs=100, instruction='ENV'):
+    """
+    A single ENV (or LABEL) with a lot of pairs on continuation lines
+    """
+    return '{instruction} '.format(instruction=instruction) + ' \\\n    '.join(
+        'KEY_{i}=value_{i}'.format(i=i) for i in range(pairs)) + '\n'
+
+
+def env_references(pairs=500):
+    """
+    ARG defaults followed by an ENV block that uses every form of variable
+    substitution on them
+    """
+    args = 'ARG ' + ' \\\n    '.join('ARG_{i}=value_{i}'.format(i=i) for i in range(pairs))
+    env = 'ENV ' + ' \\\n    '.join(
+        'KEY_{i}=$ARG_{i}/${{ARG_{i}}}/${{MISSING_{i}:-default}}/${{ARG_{i}:+set}}'.format(i=i) for i in range(pairs))
+    return 'FROM ubuntu:16.04\n' + args + '\n' + env + '\n'
+
+
+def multi_stage(stages=20, instructions=250):
+    """
+    A multi-stage dockerfile with a lot of builder stages, only one of which
+    the final stage copies out of
+    """
+    parts = []
+    for i in range(stages):
+        parts.append(huge(instructions, seed=i).replace('FROM ubuntu:16.04', 'FROM ubuntu:16.04 AS builder{i}'.format(i=i), 1))
+    parts.append('FROM ubuntu:16.04\nCOPY --from=builder0 /app /app\nRUN echo done\n')
+    return ''.join(parts)
+
+
+def lineage(depth=50, prefix='bench'):
+    """
+    A chain of `depth` images, each built from the last, as a dict of
+    `user/image` -> dockerfile. Returns the dict and the name of the last image.
+    """
+    dockerfiles = {'_/{prefix}0'.format(prefix=prefix): 'FROM scratch\n' + small().split('\n', 2)[2]}
+    for i in range(1, depth):
+        parent = '{prefix}0'.format(prefix=prefix) if i == 1 else '{prefix}/image{parent}:latest'.format(prefix=prefix, parent=i - 1)
+        dockerfiles['{prefix}/image{i}'.format(prefix=prefix, i=i)] = 'FROM {parent}\n'.format(parent=parent) + small().split('\n', 2)[2]
+    return dockerfiles, '{prefix}/image{last}'.format(prefix=prefix, last=depth - 1)
+
+
+def fleet(images=50000, tags=5, seed=0):
+    """
+    A lot of images as a list of (name, index of the parent or None,
+    dockerfile), parents always come before their children
+
+    Each repository has `tags` tags with the same dockerfile, like they do on
+    dockerhub, and is built from a tag of a repository before it.
+    """
+    rng = random.Random(seed)
+    result = []
+    for i in range(images // tags):
+        parent = rng.randrange(len(result)) if result else None
+        base = result[parent][0] if result else 'scratch'
+        dockerfile = 'FROM {base}\nRUN apt-get update && apt-get install -y {packages}\nENV IMAGE={i}\n'.format(
+            base=base, packages=' '.join(rng.sample(PACKAGES, 3)), i=i)
+        for tag in range(tags):
+            result.append(('fleet{user}/image{i}:{tag}'.format(user=i % 100, i=i, tag=tag), parent, dockerfile))
+    return result
@@ -0,0 +1,108 @@
+"""
+A local stand in for the parts of Docker Hub and the registry monolith uses
+
+    with FakeHub({'user/image': 'FROM ubuntu\n'}, latency=0.01) as hub:
+        os.environ['MONOLITH_HUB_URL'] = hub.url
+        ...
+
+Dockerfiles are served from `/v2/repositories/<user>/<image>/dockerfile/`.
+Official images can be given as `_/image` or `library/image`. Registry
+manifests and blobs can be added to `manifests` and `blobs` and are served
+from `/v2/<repository>/manifests/<reference>` and `/v2/<repository>/blobs/<digest>`
+without auth. Every response waits `latency` seconds first, and the status
+codes in `failures` are sent back for the next requests instead.
+"""
+import collections
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+
+DOCKERFILE_REGEX = re.compile(r'^/v2/repositories/([^/]+)/([^/]+)/dockerfile/?$')
+REGISTRY_REGEX = re.compile(r'^/v2/(.+)/(manifests|blobs)/([^/]+)$')
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeHub:
+    def __init__(self, dockerfiles=None, latency=0.0):
+        self.dockerfiles = {}
+        for name, dockerfile in (dockerfiles or {}).items():
+            user, image = name.split('/')
+            self.dockerfiles[('_' if user == 'library' else user, image)] = dockerfile
+        self.manifests = {}  # (repository, reference) -> (content type, manifest)
+        self.blobs = {}  # (repository, digest) -> bytes
+        self.latency = latency
+        self.failures = []  # Status codes to answer the next requests with, before answering normally
+        self.requests = collections.Counter()
+        self._server = None
+
+    def _make_handler(self):
+        hub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def send(self, code, body=b'', content_type='application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(hub.latency)
+                hub.requests[self.command] += 1
+                if hub.failures:
+                    return self.send(hub.failures.pop(0), b'{}')
+                path = self.path.split('?')[0]
+                m = DOCKERFILE_REGEX.match(path)
+                if m:
+                    user, image = m.groups()
+                    dockerfile = hub.dockerfiles.get(('_' if user == 'library' else user, image))
+                    if dockerfile is None:
+                        return self.send(404, b'{}')
+                    return self.send(200, json.dumps({'contents': dockerfile}).encode())
+                if path == '/v2/':
+                    return self.send(200, b'{}')
+                m = REGISTRY_REGEX.match(path)
+                if m:
+                    repository, kind, reference = m.groups()
+                    if kind == 'manifests' and (repository, reference) in hub.manifests:
+                        content_type, manifest = hub.manifests[(repository, reference)]
+                        return self.send(200, json.dumps(manifest).encode(), content_type)
+                    if kind == 'blobs' and (repository, reference) in hub.blobs:
+                        return self.send(200, hub.blobs[(repository, reference)], 'application/octet-stream')
+                self.send(404, b'{}')
+
+            do_HEAD = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self._server.server_port)
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), self._make_handler())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
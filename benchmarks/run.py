@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Run the benchmarks and save the results as JSON
+
+    python benchmarks/run.py -o before.json
+    ... make changes ...
+    python benchmarks/run.py -o after.json --compare before.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import corpora  # noqa: E402
+import fakehub  # noqa: E402
+import monolith.image_types  # noqa: E402
+import monolith.index  # noqa: E402
+import monolith.lexer  # noqa: E402
+import monolith.parsers  # noqa: E402
+import monolith.serve  # noqa: E402
+
+# A regression is anything this much slower than before
+REGRESSION_RATIO = 1.2
+
+
+def measure(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+
+def bench_parse(text, repeat):
+    def parse():
+        monolith.parsers.DockerFileToSingularityFile('bench/bench').parse(text)
+    # Parsed dockerfiles are memoized, start from nothing every time
+    result = measure(parse, repeat, setup=monolith.lexer.clear_cache)
+    result['bytes'] = len(text.encode())
+    result['mb_per_s'] = result['bytes'] / result['median'] / 1e6
+    return result
+
+
+def bench_key_value_pairs(text, repeat):
+    params = text.split(' ', 1)[1]
+    m = monolith.parsers.DockerFileToSingularityFile('bench/bench')
+    return measure(lambda: m.get_key_value_pairs(params), repeat)
+
+
+def bench_get_tree(depth, latency, repeat):
+    dockerfiles, name = corpora.lineage(depth)
+    with fakehub.FakeHub(dockerfiles, latency=latency) as hub:
+        monolith.image_types.DOCKERFILE_URL = hub.url + '/v2/repositories/{user}/{image}/dockerfile/'
+        monolith.image_types.DockerImage.dockerfile_cache = None
+        monolith.image_types.DockerImage.lineage_index = None
+        result = measure(lambda: monolith.image_types.DockerImage.get_tree(name), repeat)
+    result.update(depth=depth, latency=latency)
+    return result
+
+
+def bench_get_tree_indexed(depth, latency, repeat):
+    """
+    `get_tree_indexed` once the lineage is in the index
+    """
+    dockerfiles, name = corpora.lineage(depth)
+    with fakehub.FakeHub(dockerfiles, latency=latency) as hub:
+        monolith.image_types.DOCKERFILE_URL = hub.url + '/v2/repositories/{user}/{image}/dockerfile/'
+        monolith.image_types.DockerImage.dockerfile_cache = None
+        monolith.image_types.DockerImage.lineage_index = monolith.index.LineageIndex(':memory:')
+        monolith.image_types.DockerImage.get_tree_indexed(name)
+        result = measure(lambda: monolith.image_types.DockerImage.get_tree_indexed(name), repeat)
+        monolith.image_types.DockerImage.lineage_index = None
+    result.update(depth=depth, latency=latency)
+    return result
+
+
+def bench_script(depth, latency, repeat, extra_args=()):
+    """
+    Run `scripts/monolith` from start to finish, including starting python
+    """
+    dockerfiles, name = corpora.lineage(depth)
+    with fakehub.FakeHub(dockerfiles, latency=latency) as hub, tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, MONOLITH_HUB_URL=hub.url, PYTHONPATH=ROOT,
+                   MONOLITH_INDEX_PATH=os.path.join(folder, 'lineage.db'))
+        cmd = [sys.executable, os.path.join(ROOT, 'scripts', 'monolith'), '--no-cache',
+               '-f', os.path.join(folder, 'Monolith.txt'), *extra_args, name]
+        result = measure(lambda: subprocess.run(cmd, env=env, cwd=folder, check=True,
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), repeat)
+    result.update(depth=depth, latency=latency)
+    return result
+
+
+def bench_convert(repeat):
+    """
+    `monolith convert` on one small dockerfile, this is mostly starting python and importing
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'Dockerfile'), 'w') as f:
+            f.write(corpora.small())
+        cmd = [sys.executable, os.path.join(ROOT, 'scripts', 'monolith'), 'convert', 'Dockerfile']
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        return measure(lambda: subprocess.run(cmd, env=env, cwd=folder, check=True,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), repeat)
+
+
+def bench_serve(depth, latency, repeat):
+    """
+    A Singularity file from `monolith serve` once it is warm, over HTTP
+    """
+    dockerfiles, name = corpora.lineage(depth)
+    with fakehub.FakeHub(dockerfiles, latency=latency) as hub, tempfile.TemporaryDirectory() as folder:
+        monolith.image_types.DOCKERFILE_URL = hub.url + '/v2/repositories/{user}/{image}/dockerfile/'
+        monolith.image_types.DockerImage.dockerfile_cache = None
+        monolith.image_types.DockerImage.lineage_index = None
+        server = monolith.serve.make_server(monolith.serve.ConversionService(folder), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        connection = http.client.HTTPConnection(*server.server_address)
+
+        def get():
+            connection.request('GET', '/singularity/' + name)
+            connection.getresponse().read()
+        try:
+            get()
+            result = measure(get, repeat)
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+    result.update(depth=depth, latency=latency)
+    return result
+
+
+class PlainDockerImage:
+    """
+    A node the way `DockerImage` used to be, to compare the memory against
+    """
+    def __init__(self, name, dockerfile=None, children=None, parent=None):
+        self.name = name
+        self.dockerfile = dockerfile if dockerfile else ""
+        self.children = children if children else {}
+        self.parent = parent if parent else None
+        self._segment = None
+
+    def add_child(self, child):
+        self.children[child.name] = child
+
+    def get_lineage(self):
+        lineage = []
+        seen = set()
+        image = self
+        while image:
+            if id(image) in seen:
+                raise ValueError("{name} is built from itself".format(name=image.name))
+            seen.add(id(image))
+            lineage.append(image)
+            image = image.parent
+        lineage.reverse()
+        return lineage
+
+
+def build_graph(cls, fleet):
+    """
+    The nodes for `corpora.fleet`, with every name and dockerfile its own
+    string like they are when they come from dockerhub
+    """
+    nodes = []
+    for name, parent, dockerfile in fleet:
+        node = cls(name=name.encode().decode())
+        node.dockerfile = dockerfile.encode().decode()
+        if parent is not None:
+            node.parent = nodes[parent]
+            nodes[parent].add_child(node)
+        nodes.append(node)
+    return nodes
+
+
+def graph_memory(cls, fleet):
+    """
+    How many bytes the graph of `fleet` takes, and how many once the lineage
+    of every image has been looked up
+    """
+    monolith.image_types.DockerImage.dockerfile_bodies = monolith.image_types.DockerfileBodies()
+    tracemalloc.start()
+    try:
+        nodes = build_graph(cls, fleet)
+        graph = tracemalloc.get_traced_memory()[0]
+        for node in nodes:
+            node.get_lineage()
+        return graph, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_graph(images, repeat):
+    """
+    Build a graph of a lot of images and look up every lineage, along with
+    the memory it takes compared to the old `DockerImage`
+    """
+    fleet = corpora.fleet(images)
+
+    def build():
+        monolith.image_types.DockerImage.dockerfile_bodies = monolith.image_types.DockerfileBodies()
+        for node in build_graph(monolith.image_types.DockerImage, fleet):
+            node.get_lineage()
+    result = measure(build, repeat)
+    result['images'] = images
+    result['bytes'], result['bytes_with_lineages'] = graph_memory(monolith.image_types.DockerImage, fleet)
+    result['plain_bytes'], result['plain_bytes_with_lineages'] = graph_memory(PlainDockerImage, fleet)
+    monolith.image_types.DockerImage.dockerfile_bodies = monolith.image_types.DockerfileBodies()
+    return result
+
+
+def run(quick=False):
+    scale = 10 if quick else 1
+    repeat = 3 if quick else 7
+    benchmarks = {
+        'parse_small': lambda: bench_parse(corpora.small(), repeat * 10),
+        'parse_huge': lambda: bench_parse(corpora.huge(5000 // scale), repeat),
+        'parse_continuation_heavy': lambda: bench_parse(corpora.continuation_heavy(20000 // scale), repeat),
+        'parse_adversarial': lambda: bench_parse(corpora.adversarial(100000 // scale), repeat),
+        'parse_env_references_500': lambda: bench_parse(corpora.env_references(500 // scale), repeat),
+        'parse_multi_stage_20': lambda: bench_parse(corpora.multi_stage(20 // scale), repeat),
+        'key_value_pairs_env_10': lambda: bench_key_value_pairs(corpora.env_list(10), repeat * 10),
+        'key_value_pairs_env_500': lambda: bench_key_value_pairs(corpora.env_list(500 // scale), repeat),
+        'key_value_pairs_label_500': lambda: bench_key_value_pairs(corpora.env_list(500 // scale, 'LABEL'), repeat),
+        'get_tree_depth_50': lambda: bench_get_tree(50 // scale, 0.005, repeat),
+        'get_tree_indexed_depth_50': lambda: bench_get_tree_indexed(50 // scale, 0.005, repeat),
+        'script_monolith_depth_20': lambda: bench_script(20 // scale, 0.005, repeat),
+        'script_singularity_depth_20': lambda: bench_script(20 // scale, 0.005, repeat, ['--make-singularity']),
+        'script_convert': lambda: bench_convert(repeat * 2),
+        'serve_singularity_depth_20': lambda: bench_serve(20 // scale, 0.005, repeat * 10),
+        'graph_50k': lambda: bench_graph(50000 // scale, repeat),
+    }
+    results = {}
+    for name, bench in benchmarks.items():
+        results[name] = bench()
+        print("{name:32} median {median:9.4f}s  min {min:9.4f}s".format(name=name, **results[name]))
+        if 'plain_bytes' in results[name]:
+            print("{name:32} {bytes} bytes ({bytes_with_lineages} with lineages), {plain_bytes} with plain nodes".format(name='', **results[name]))
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Print how each benchmark changed, returns the names of the regressions
+    """
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        ratio = result['median'] / old['results'][name]['median']
+        flag = ''
+        if ratio > REGRESSION_RATIO:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{name:32} {old:9.4f}s -> {new:9.4f}s  x{ratio:.2f}{flag}".format(
+            name=name, old=old['results'][name]['median'], new=result['median'], ratio=ratio, flag=flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark monolith")
+    parser.add_argument('-o', '--output', help="Where to write the results", default='benchmark.json')
+    parser.add_argument('--compare', help="Results from an earlier run to compare against")
+    parser.add_argument('--quick', action='store_true', help="Smaller inputs and fewer repeats")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = {'commit': get_commit(),
+               'date': str(datetime.datetime.now()),
+               'python': platform.python_version(),
+               'quick': args.quick,
+               'results': run(quick=args.quick)}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results):
+                sys.exit(1)
@@ -6,14 +6,18 @@ Look at a docker image and make a singularity image that uses it with the proper
 import re
 import json
 import argparse
-import subprocess
-import shlex
-import inspect
-import os
-import requests as r
-import image_types
+import concurrent.futures
 
-DOCKER_REGISTRY_URL = 'https://registry.hub.docker.com/v2/'
+try:
+    import parsers
+    import registry
+except ModuleNotFoundError:
+    import monolith.parsers as parsers
+    import monolith.registry as registry
+
+DOCKER_REGISTRY_URL = registry.DOCKER_REGISTRY_URL
+# Shared so the auth realm, tokens and manifests are reused between images
+default_registry = registry.Registry(DOCKER_REGISTRY_URL)
 
 
 def gen_scope(name):
@@ -38,79 +42,54 @@ def docker_env_to_singularity(env):
     return string
 
 
-def get_docker_image_history(image_name):
+def get_docker_image_history(image_name, client=default_registry):
     print('Processing: ' + image_name)
-    image = image_types.DockerImage(image_name)
-    print("Got User: {user}; Image: {image}; Ref: {ref}".format(user=image.get_docker_info().user, image=image.get_docker_info().image, ref=image.get_docker_info().ref))
-
-    print("Getting auth token for docker registry")
-    # Get the OAuth token from docker
-    # https://docs.docker.com/registry/spec/auth/token/#how-to-authenticate
-    auth_url, service = re.search(r'realm="(.*)",service="(.*)"', r.get(DOCKER_REGISTRY_URL).headers['Www-Authenticate']).groups()
-    token = r.get(auth_url + "?service={service}".format(service=service) + gen_scope(image.gen_name())).json()['token']
-    headers = {'Authorization': 'Bearer {token}'.format(token=token),
-               'Accept': 'application/vnd.docker.distribution.manifest.list.v2+json'}
-    headers_v2 = {'Authorization': 'Bearer {token}'.format(token=token),
-               'Accept': 'application/vnd.docker.distribution.manifest.v2+json'}
+    repository, ref = client.get_repository(image_name)
+    print("Got Repository: {repository}; Ref: {ref}".format(repository=repository, ref=ref))
 
     # XXX The docker registry doesnt give back history if given a digest (ie. sha256:blah)
-    url = '{name}/manifests/{ref}'.format(name=image.gen_name(), ref=image.get_docker_info().ref)
-    print("Looking up: " + url)
-    resp = r.get(DOCKER_REGISTRY_URL + url, headers=headers)
-    image_manifest = resp.json()
-    image_history = image_manifest['history']
-    top = json.loads(image_history[0]['v1Compatibility'])
-    env = top['config']['Env']
-
-    # Get the image digest, need to use the v2 manifest to get the correct hash
-    resp = r.head(DOCKER_REGISTRY_URL + url, headers=headers_v2)
-    digest = resp.headers['Docker-Content-Digest']
+    # The history is only in the v1 manifest
+    _, image_manifest, _ = client.get_raw_manifest(repository, ref, registry.MANIFEST_LIST_V2)
 
-    full_image_name = image.gen_name() + '@{digest}'.format(digest=digest)
-    envs = '\n    '.join(docker_env_to_singularity(i) for i in env)
+    # Decode every entry once
+    image_history = [json.loads(i['v1Compatibility']) for i in image_manifest['history']]
 
     # Get all the history for this image
     # It is in reverse order, ie. 0 is the last command
-    history = [' '.join(json.loads(i['v1Compatibility'])['container_config']['Cmd']) for i in image_history]
+    history = [' '.join(i['container_config']['Cmd']) for i in image_history]
     return history
 
 
+def get_docker_image_histories(image_names, client=default_registry, max_workers=8):
+    """
+    Get the history of many images at once, returns a dict of name -> history
+    """
+    # One token for everything, rather than one per image
+    client.prefetch_tokens(client.get_repository(name)[0] for name in image_names)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(zip(image_names, pool.map(lambda name: get_docker_image_history(name, client=client), image_names)))
+
+
+def get_singularity_file(image_name, client=default_registry):
+    """
+    Make a singularity definition file for `image_name` from its manifest and
+    config in the registry, the dockerfiles are not needed
+    """
+    repository, digest, config = client.get_config(image_name)
+    parser = parsers.DockerFileToSingularityFile(image_name)
+    parser.bootstrap = 'docker'
+    parser.image = '{repository}@{digest}'.format(repository=repository, digest=digest)
+    parser.parse_image_config(config)
+    return parser.singularity_file()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Generate a singularity definition file from a docker image")
     parser.add_argument('-f', '--file', type=str, help="Where to write the file out to", default='Singularity')
-    parser.add_argument('image_name', type=str, help="The name of the image, as such: 'nvidia/cuda:8.0-cudnn5-devel'. We don't support digests at this time")
+    parser.add_argument('image_name', type=str, help="The name of the image, as such: 'nvidia/cuda:8.0-cudnn5-devel'")
     args = parser.parse_args()
 
-    history = get_docker_image_history(args.image_name)
-    
-    # Get the ENTRYPOINT
-    entrypoints = [i for i in history if 'ENTRYPOINT' in i]  # TODO is ENTRYPOINT always in caps?
-    entrypoint = entrypoints.pop(0) if len(entrypoints) > 0 else ''
-    if len(entrypoints) > 0:
-        entrypoint = entrypoints.pop(0)  # Grab the first entry
-        # Do some string manipulation to see what we need to do
-        entrypoint = entrypoint[entrypoint.find('ENTRYPOINT')+3:].strip()
-        if entrypoint.startswith('['):
-            entrypoint = ' '.join(re.findall(r'\[(.*)\]', cmd))  # Get everything in the brackets
-            entrypoint = ' '.join(cmd.replace('"', '').split(','))  # Flaten out the string
-        # If it's not in list form, don't do anything
-    else:
-        entrypoint = ''
-
-    cmds = [i for i in history if 'CMD' in i]  # TODO is CMD always in caps?
-    if len(cmds) > 0:
-        cmd = cmds.pop(0)  # Grab the first entry
-        # Do some string manipulation to see what we need to do
-        cmd = cmd[cmd.find('CMD')+3:].strip()
-        if cmd.startswith('['):
-            cmd = ' '.join(re.findall(r'\[(.*)\]', cmd))  # Get everything in the brackets
-            cmd = ' '.join(cmd.replace('"', '').split(','))  # Flaten out the string
-        # If it's not in list form, don't do anything
-    else:
-        cmd = ''
-
-    singularity_file = FILE_TEMPLATE.format(IMAGE=full_image_name, ENVS=envs, ENTRYPOINT=entrypoint, CMD=cmd)
-    
+    singularity_file = get_singularity_file(args.image_name)
+
     with open(args.file, 'w') as f:
         f.write(singularity_file)
-
@@ -0,0 +1,207 @@
+"""
+Parse a lot of dockerfiles at once and gather statistics about them
+
+    monolith analyze path/to/dockerfiles --json stats.json --csv files.csv
+    monolith analyze 'repos/**/Dockerfile'
+
+The dockerfiles are parsed on a process pool in chunks. Nothing is pulled or
+extracted, only the parsing is done.
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import lexer
+    import parsers
+    import stages
+except ModuleNotFoundError:
+    import monolith.lexer as lexer
+    import monolith.parsers as parsers
+    import monolith.stages as stages
+
+DEFAULT_CHUNK_SIZE = 256
+CSV_FIELDS = ['path', 'base_image', 'stages', 'instructions', 'add_copy', 'lines', 'bytes', 'error']
+
+
+def is_dockerfile(filename):
+    name = os.path.basename(filename).lower()
+    return name.startswith('dockerfile') or name.endswith('.dockerfile')
+
+
+def find_dockerfiles(patterns):
+    """
+    Yield the dockerfiles in each of `patterns`, which are files, folders to
+    search or globs
+    """
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(files):
+                    if is_dockerfile(name):
+                        yield os.path.join(root, name)
+        elif os.path.isfile(pattern):
+            yield pattern
+        else:
+            for filename in sorted(glob.iglob(pattern, recursive=True)):
+                if os.path.isfile(filename):
+                    yield filename
+
+
+def analyze_dockerfile(code):
+    """
+    The statistics for one dockerfile
+    """
+    instructions = lexer.get_instructions(code)
+    graph = stages.StageGraph(instructions)
+    result = {'base_image': None,
+              'stages': len(graph.stages),
+              'instructions': collections.Counter(instruction.instruction for instruction in instructions),
+              'add_copy': 0,
+              'lines': code.count('\n'),
+              'bytes': len(code),
+              'error': None}
+    try:
+        result['base_image'] = parsers.DockerFileToSingularityFile.get_base_image(code) or None
+        m = parsers.DockerFileToSingularityFile(None)
+        m.parse(code)
+        # Nothing is extracted, but this is everything that would have been
+        result['add_copy'] = sum(len(srcs) or 1 for srcs, dest in m._pending_files)
+    except Exception as e:
+        result['error'] = '{name}: {error}'.format(name=type(e).__name__, error=e)
+    return result
+
+
+def analyze_files(filenames):
+    """
+    Analyze a chunk of files, this is what runs in each worker
+    """
+    # Unknown instructions and such would be logged for every file
+    logging.disable(logging.WARNING)
+    results = []
+    for filename in filenames:
+        try:
+            with open(filename, encoding='utf-8', errors='replace') as f:
+                result = analyze_dockerfile(f.read())
+        except OSError as e:
+            result = {'error': '{name}: {error}'.format(name=type(e).__name__, error=e)}
+        result['path'] = filename
+        results.append(result)
+    return results
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Summary:
+    """
+    The statistics for every file put together
+    """
+    def __init__(self):
+        self.files = 0
+        self.failures = []
+        self.base_images = collections.Counter()
+        self.instructions = collections.Counter()
+        self.stages = collections.Counter()
+        self.add_copy = 0
+        self.lines = 0
+        self.bytes = 0
+
+    def add(self, result):
+        self.files += 1
+        if result.get('error'):
+            self.failures.append({'path': result['path'], 'error': result['error']})
+        if result.get('base_image'):
+            self.base_images[result['base_image']] += 1
+        self.instructions.update(result.get('instructions', {}))
+        if 'stages' in result:
+            self.stages[result['stages']] += 1
+        self.add_copy += result.get('add_copy', 0)
+        self.lines += result.get('lines', 0)
+        self.bytes += result.get('bytes', 0)
+
+    def to_dict(self):
+        return {'files': self.files,
+                'parsed': self.files - len(self.failures),
+                'failed': len(self.failures),
+                'lines': self.lines,
+                'bytes': self.bytes,
+                'add_copy_sources': self.add_copy,
+                'base_images': dict(self.base_images.most_common()),
+                'instructions': dict(self.instructions.most_common()),
+                'stages': {str(count): files for count, files in sorted(self.stages.items())},
+                'failures': self.failures}
+
+
+def analyze(filenames, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the results for each of `filenames`, in the order they finish
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = set()
+        limit = 4 * (workers or os.cpu_count() or 1)
+        for chunk in chunks(filenames, chunk_size):
+            # Don't get too far ahead of the workers with a huge listing
+            if len(futures) >= limit:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            futures.add(pool.submit(analyze_files, chunk))
+        for future in concurrent.futures.as_completed(futures):
+            yield from future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='monolith analyze', description="Gather statistics about a lot of dockerfiles")
+    parser.add_argument('paths', nargs='+', help="Dockerfiles, folders to look for them in, or globs ('repos/**/Dockerfile')")
+    parser.add_argument('--json', metavar='FILE', help="Write the statistics for all the files here; Default is stdout")
+    parser.add_argument('--csv', metavar='FILE', help="Write a row for every file here")
+    parser.add_argument('-j', '--workers', type=int, help="How many processes to parse with; Default is one per cpu")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="How many files to give a process at once")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    summary = Summary()
+    csv_file = open(args.csv, 'w', newline='') if args.csv else None
+    try:
+        writer = csv.DictWriter(csv_file, CSV_FIELDS, extrasaction='ignore') if csv_file else None
+        if writer:
+            writer.writeheader()
+        for result in analyze(find_dockerfiles(args.paths), workers=args.workers, chunk_size=args.chunk_size):
+            summary.add(result)
+            if writer:
+                writer.writerow(dict(result, instructions=sum(result.get('instructions', {}).values())))
+    finally:
+        if csv_file:
+            csv_file.close()
+
+    stats = summary.to_dict()
+    stats['seconds'] = time.perf_counter() - start
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats, f, indent=2)
+    else:
+        json.dump(stats, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    logging.info("Analyzed {files} dockerfiles in {seconds:.2f}s, {failed} failed".format(**stats))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,198 @@
+"""
+On-disk cache for Dockerfiles fetched from dockerhub
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get('MONOLITH_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'monolith', 'dockerfiles'))
+DEFAULT_TTL = 24 * 60 * 60  # One day
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024  # 64 MiB of dockerfile text
+
+
+class DockerfileCache:
+    """
+    A content cache of dockerfiles keyed by `user/image:tag`
+
+    Each entry is stored in its own file, the metadata (etag, last modified,
+    when it was fetched and last used) is kept in `index.json` next to them.
+    Reading an entry only marks it as used in memory, the index is written
+    when entries are added or evicted and by `flush`, at the latest on exit.
+    Entries older than `ttl` seconds are stale and should be revalidated with
+    the headers from `conditional_headers`. When the total size goes over
+    `max_size` the least recently used entries are evicted.
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, folder=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._index = None
+        self._dirty = False  # Has the index changed since it was written
+        self._flush_at_exit = False
+
+    @staticmethod
+    def key(user, image, tag):
+        return '{user}/{image}:{tag}'.format(user=user, image=image, tag=tag)
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha256(key.encode()).hexdigest())
+
+    @property
+    def index(self):
+        """
+        Lazily load the index so creating a cache never touches the disk
+        """
+        if self._index is None:
+            try:
+                with open(os.path.join(self.folder, self.INDEX_NAME)) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.folder, self.INDEX_NAME))
+        self._dirty = False
+
+    def flush(self):
+        """
+        Write the access times of entries that were only read
+        """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def get(self, key):
+        """
+        Return the metadata for `key` or None if it is not cached
+        """
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is not None and not os.path.exists(self._path(key)):
+                # The file was removed out from under us
+                del self.index[key]
+                entry = None
+            return entry
+
+    def lookup(self, key):
+        """
+        Return the metadata for `key` (or None) and if it can be used without
+        revalidating, counting it as a hit or a miss
+        """
+        with self._lock:
+            entry = self.get(key)
+            fresh = entry is not None and self.is_fresh(entry)
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry, fresh
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched'] < self.ttl
+
+    def conditional_headers(self, entry):
+        """
+        Headers to revalidate a stale entry with
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def read(self, key):
+        """
+        Return the cached text for `key` and mark it as recently used
+        """
+        with self._lock:
+            with open(self._path(key)) as f:
+                text = f.read()
+            self.index[key]['accessed'] = time.time()
+            self._dirty = True
+            if not self._flush_at_exit:
+                self._flush_at_exit = True
+                atexit.register(self.flush)
+            return text
+
+    def put(self, key, text, etag=None, last_modified=None):
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.folder)
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(tmp, self._path(key))
+            now = time.time()
+            self.index[key] = {'etag': etag,
+                               'last_modified': last_modified,
+                               'fetched': now,
+                               'accessed': now,
+                               'size': len(text.encode())}
+            self.evict()
+            self._save_index()
+
+    def revalidated(self, key):
+        """
+        The server said our copy is still good (304), start the ttl over
+        """
+        with self._lock:
+            self.revalidations += 1
+            self.index[key]['fetched'] = time.time()
+            self._save_index()
+
+    def size(self):
+        return sum(entry['size'] for entry in self.index.values())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until we are under `max_size`
+        """
+        with self._lock:
+            total = self.size()
+            for key in sorted(self.index, key=lambda k: self.index[k]['accessed']):
+                if total <= self.max_size:
+                    break
+                total -= self.index[key]['size']
+                del self.index[key]
+                self.evictions += 1
+                logging.debug("Evicting `{key}` from the dockerfile cache".format(key=key))
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.index):
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+            self._index = {}
+            self._save_index()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'entries': len(self.index),
+                'size': self.size()}
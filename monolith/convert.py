@@ -0,0 +1,141 @@
+"""
+Convert local dockerfiles to Singularity files, without touching the network
+
+    monolith convert path/to/Dockerfile
+    monolith convert -o singularity/ */Dockerfile
+    cat Dockerfile | monolith convert -
+
+Only the dockerfiles themselves are read. Their base image is not looked up,
+and ADD and COPY take their files from the build context (the folder the
+dockerfile is in, or `--context`) instead of getting them out of an image.
+
+This only imports `parsers` so it starts quickly, which matters when it is
+run once for every dockerfile in a repository.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+
+try:
+    import parsers
+    import stages
+except ModuleNotFoundError:
+    import monolith.parsers as parsers
+    import monolith.stages as stages
+
+
+class LocalDockerFileToSingularityFile(parsers.DockerFileToSingularityFile):
+    """
+    ADD and COPY are files in the build context on this machine
+    """
+    extractor = None
+    artifact_store = None
+
+    def __init__(self, docker_image_name, folder='./', optimize=False, context='.'):
+        super().__init__(docker_image_name, folder=folder, optimize=optimize)
+        self.context = context
+
+    def COPY(self, params):
+        m = stages.COPY_FROM_REGEX.search(params)
+        if m:
+            # Those files are made while building the image, they aren't anywhere here
+            logging.warning("Skipping `COPY %s`, `--from=%s` can only be gotten out of a built image", params.strip(), m.group(1))
+            return
+        return self.ADD(params)
+
+    def extract_files(self):
+        """
+        Copy each ADD and COPY from the build context with %files
+        """
+        pending, self._pending_files = self._pending_files, []
+        for srcs, dest in pending:
+            if len(srcs) > 1 or dest.endswith('/'):
+                folder = dest
+            else:
+                folder = os.path.dirname(dest)
+            if folder:
+                self.setup.append('\n    mkdir -p $SINGULARITY_ROOTFS/{folder}'.format(folder=folder))
+            for src in srcs:
+                if re.match(r'^https?://', src):
+                    logging.warning("Skipping `%s`, urls are not downloaded", src)
+                    continue
+                # Like docker, nothing from outside of the build context
+                path = os.path.normpath(src.lstrip('/'))
+                if path == os.pardir or path.startswith(os.pardir + os.sep):
+                    logging.warning("Skipping `%s`, it is outside of the build context", src)
+                    continue
+                self.files.append('\n    {src} {dest}'.format(src=os.path.join(self.context, path), dest=dest))
+
+
+def convert(code, name='Dockerfile', context='.', bootstrap='docker', _from=None, target=None, optimize=False):
+    """
+    Return the Singularity file for the dockerfile `code`
+    """
+    parser = LocalDockerFileToSingularityFile(name, optimize=optimize, context=context)
+    parser.parse(code, target=target)
+    parser.bootstrap = bootstrap
+    if _from:
+        parser.image = _from
+    return parser.singularity_file()
+
+
+def get_output(args, filename):
+    """
+    Where the Singularity file for `filename` goes, None for stdout
+    """
+    if args.output_dir is None:
+        return None
+    if len(args.dockerfiles) == 1:
+        return os.path.join(args.output_dir, args.file)
+    # Each one gets a folder, like images do
+    return os.path.join(args.output_dir, re.sub(r'[^\w.\-]', '_', os.path.normpath(filename)), args.file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='monolith convert', description="Convert local dockerfiles to Singularity files, offline")
+    parser.add_argument('dockerfiles', nargs='*', default=['-'], help="Dockerfiles to convert, `-` or nothing reads one from stdin")
+    parser.add_argument('-o', '--output-dir', help="Where to write the files; with more than one dockerfile each one gets a folder in here. Default is stdout")
+    parser.add_argument('-f', '--file', default='Singularity', help="The name of the files written to --output-dir")
+    parser.add_argument('--context', help="The build context ADD and COPY are relative to; Default is the folder of each dockerfile")
+    parser.add_argument('--singularity-bootstrap', default='docker', help="Sets the Bootstrap field of the Singularity definition file")
+    parser.add_argument('--singularity-from', help="Sets the From field of the Singularity definition file; Default is the FROM of the dockerfile")
+    parser.add_argument('--target', help="The stage of a multi-stage dockerfile to convert; Default is the last one")
+    parser.add_argument('--optimize', action='store_true', help="Merge the apt-get and pip steps repeated in %%post")
+    args = parser.parse_args(argv)
+    if args.output_dir is None and len(args.dockerfiles) > 1:
+        parser.error("--output-dir is needed to convert more than one dockerfile")
+
+    failed = 0
+    for filename in args.dockerfiles:
+        try:
+            if filename == '-':
+                code = sys.stdin.read()
+                context = args.context or '.'
+            else:
+                with open(filename) as f:
+                    code = f.read()
+                context = args.context or os.path.dirname(filename) or '.'
+            singularity = convert(code, name=filename, context=context, bootstrap=args.singularity_bootstrap,
+                                  _from=args.singularity_from, target=args.target, optimize=args.optimize)
+        except Exception as e:
+            logging.error("Could not convert `%s`: %s", filename, e)
+            failed += 1
+            continue
+
+        output = get_output(args, filename)
+        if output is None:
+            sys.stdout.write(singularity)
+            continue
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as f:
+            f.write("# Created with `monolith convert {filename}`\n".format(filename=filename))
+            f.write(singularity)
+        logging.info("Wrote %s", output)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
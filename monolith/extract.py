@@ -0,0 +1,266 @@
+"""
+Get files out of docker images for ADD and COPY
+"""
+import collections
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tarfile
+import tempfile
+import threading
+
+try:
+    import tracing
+except ModuleNotFoundError:
+    import monolith.tracing as tracing
+
+# Most of a file that is held in memory at once while it is being extracted
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# What `docker cp` says when the path isn't in the container
+MISSING_PATH_REGEX = re.compile(r'no such container:path|could not find the file', re.IGNORECASE)
+
+# A file that was gotten out of an image
+ExtractedFile = collections.namedtuple('ExtractedFile', ['filename', 'sha256', 'size'])
+
+
+def local_path(folder, path):
+    """
+    Where `path` from an image goes under `folder`
+
+    Paths come from dockerfiles we don't control, so one that would end up
+    outside of `folder` (`/../../etc/passwd`) raises a ValueError
+    """
+    filename = os.path.join(folder, os.path.normpath('/' + path).lstrip('/'))
+    root = os.path.abspath(folder)
+    if os.path.commonpath([root, os.path.abspath(filename)]) != root:
+        raise ValueError("`{path}` is outside of `{folder}`".format(path=path, folder=folder))
+    return filename
+
+
+def stream_to_file(fileobj, filename, chunk_size=DEFAULT_CHUNK_SIZE, mode=0o644):
+    """
+    Copy `fileobj` to `filename` `chunk_size` bytes at a time
+
+    The data goes to a temporary file first that is renamed into place once
+    it is complete, so `filename` is never left half written. Returns an
+    `ExtractedFile` with the sha256 of the data.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        # No setuid, setgid or sticky bits from an image on this machine
+        os.chmod(tmp, mode & 0o777)
+        os.replace(tmp, filename)
+        tracing.count('bytes_extracted', size)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return ExtractedFile(filename, digest.hexdigest(), size)
+
+
+class DockerExtractor:
+    """
+    Copy files out of images with the local docker daemon
+
+    Each image is pulled at most once, and all the files wanted from an image
+    are copied out of a single container that is created but never started.
+    """
+    def __init__(self, docker='docker', chunk_size=DEFAULT_CHUNK_SIZE):
+        self.docker = docker
+        self.chunk_size = chunk_size
+        self.pulled = set()
+        self._lock = threading.Lock()
+        self._pulling = {}  # Image -> lock held while it is pulled
+
+    def pull(self, image):
+        """
+        Pull `image` unless it already was. If the pull fails it is tried
+        again the next time.
+        """
+        with self._lock:
+            if image in self.pulled:
+                return
+            lock = self._pulling.setdefault(image, threading.Lock())
+        # Only one thread pulls an image, the others wait for it
+        with lock:
+            if image in self.pulled:
+                return
+            logging.info("Pulling `%s`", image)
+            with tracing.span('docker pull', category='docker', image=image):
+                subprocess.run([self.docker, 'pull', image], check=True)
+            with self._lock:
+                self.pulled.add(image)
+                del self._pulling[image]
+
+    def digest(self, image):
+        """
+        The id of the image, this changes whenever the image does
+        """
+        self.pull(image)
+        with tracing.span('docker inspect', category='docker', image=image):
+            process = subprocess.run([self.docker, 'image', 'inspect', '--format', '{{.Id}}', image],
+                                     stdout=subprocess.PIPE, check=True)
+        return process.stdout.decode().strip()
+
+    def create(self, image):
+        """
+        Create (but don't start) a container to copy files out of, returns its id
+        """
+        # The command is never run, it is only there so images without one can be created
+        with tracing.span('docker create', category='docker', image=image):
+            process = subprocess.run([self.docker, 'create', '--entrypoint', '/bin/true', image],
+                                     stdout=subprocess.PIPE, check=True)
+        return process.stdout.decode().strip()
+
+    def remove(self, container):
+        with tracing.span('docker rm', category='docker'):
+            subprocess.run([self.docker, 'rm', '-f', container], stdout=subprocess.DEVNULL)
+
+    def copy(self, container, path, folder):
+        """
+        Copy `path` out of `container` into `folder`, under the same path it has in the image
+
+        Returns an `ExtractedFile`, or None if `path` does not exist or is not
+        a regular file. Any other failure of `docker cp` is raised as a
+        `subprocess.CalledProcessError`. The file is streamed to disk, at most
+        `chunk_size` bytes of it are in memory at a time.
+        """
+        args = [self.docker, 'cp', '{container}:{path}'.format(container=container, path=path), '-']
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=self.chunk_size)
+        extracted = None
+        member = None
+        try:
+            # `docker cp` to `-` streams a tar with `path` as the first entry
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                member = tar.next()
+                if member is not None and member.isfile():
+                    filename = local_path(folder, path)
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    extracted = stream_to_file(tar.extractfile(member),
+                                               filename,
+                                               self.chunk_size,
+                                               mode=member.mode)
+        except tarfile.ReadError:
+            # Nothing (or not a tar) was sent, what went wrong is on stderr
+            pass
+        finally:
+            process.stdout.close()
+            if member is not None and extracted is None:
+                # Don't wait for the rest of a directory we don't want
+                process.kill()
+            stderr = process.stderr.read().decode(errors='replace')
+            process.stderr.close()
+            process.wait()
+
+        if member is not None and not member.isfile():
+            return None
+        if process.returncode != 0 or extracted is None:
+            if process.returncode != 0 and MISSING_PATH_REGEX.search(stderr):
+                return None
+            if extracted is not None:
+                os.remove(extracted.filename)
+            raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
+        return extracted
+
+    def extract(self, image, paths, folder):
+        """
+        Copy each of `paths` out of `image` into `folder`
+
+        Returns a dict of path -> `ExtractedFile`, or None for paths that are
+        missing or are not regular files
+        """
+        self.pull(image)
+        container = self.create(image)
+        try:
+            extracted = {}
+            for path in paths:
+                with tracing.span('docker cp', category='docker', path=path):
+                    extracted[path] = self.copy(container, path, folder)
+            return extracted
+        finally:
+            self.remove(container)
+
+
+class RegistryExtractor:
+    """
+    Get files straight out of the layers in a docker registry, no docker needed
+
+    The layers are read newest first and each one is decompressed as it is
+    downloaded. As soon as every path has been found (or deleted by a
+    whiteout) nothing more is downloaded.
+    """
+    def __init__(self, registry=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        if registry is None:
+            try:
+                import registry as _registry
+            except ModuleNotFoundError:
+                import monolith.registry as _registry
+            registry = _registry.Registry()
+        self.registry = registry
+        self.chunk_size = chunk_size
+
+    def digest(self, image):
+        repository, digest, manifest = self.registry.get_manifest(image)
+        return digest
+
+    def extract(self, image, paths, folder):
+        """
+        Copy each of `paths` out of `image` into `folder`
+
+        Returns a dict of path -> `ExtractedFile`, or None for paths that are
+        missing or are not regular files
+        """
+        repository, digest, manifest = self.registry.get_manifest(image)
+        extracted = {path: None for path in paths}
+        # Paths in layers are relative, without a leading `/`
+        wanted = {os.path.normpath(path).lstrip('/'): path for path in paths}
+
+        for layer in reversed(manifest['layers']):
+            logging.debug("Looking in layer %s of `%s`", layer['digest'], image)
+            whiteouts = []
+            resp = self.registry.get_blob(repository, layer['digest'], stream=True)
+            try:
+                with tracing.span('layer', category='registry', digest=layer['digest']), \
+                        tarfile.open(fileobj=resp.raw, mode='r|*') as tar:
+                    for member in tar:
+                        name = os.path.normpath(member.name).lstrip('/')
+                        dirname, basename = os.path.split(name)
+                        if basename.startswith('.wh.'):
+                            # Whiteouts hide things in the layers below this one
+                            whiteouts.append(dirname if basename == '.wh..wh..opq' else os.path.join(dirname, basename[4:]))
+                            continue
+                        path = wanted.pop(name, None)
+                        if path is None:
+                            continue
+                        if member.isfile():
+                            filename = local_path(folder, path)
+                            os.makedirs(os.path.dirname(filename), exist_ok=True)
+                            extracted[path] = stream_to_file(tar.extractfile(member), filename,
+                                                             self.chunk_size, mode=member.mode)
+                        if not wanted:
+                            break
+            finally:
+                resp.close()
+
+            for whiteout in whiteouts:
+                for name in [name for name in wanted if name == whiteout or name.startswith(whiteout + '/')]:
+                    del wanted[name]
+            if not wanted:
+                break
+        return extracted
+
+
+# Shared so images are only pulled once per run
+default_extractor = DockerExtractor()
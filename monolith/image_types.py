@@ -1,36 +1,346 @@
+import asyncio
+import collections.abc
+import concurrent.futures
+import datetime
+import functools
 import logging
+import os
 import re
-import requests
+import sys
+import tempfile
+import threading
 
 try:
     import parsers
+    import cache
+    import index
+    import tracing
+    import transport
 except ModuleNotFoundError:
     import monolith.parsers as parsers
+    import monolith.cache as cache
+    import monolith.index as index
+    import monolith.tracing as tracing
+    import monolith.transport as transport
 
-BASE_URL = "https://hub.docker.com/v2/repositories/{user}/{image}/"
+# Can be pointed at a mirror (or a stand in for benchmarks) with $MONOLITH_HUB_URL
+HUB_URL = os.environ.get('MONOLITH_HUB_URL', 'https://hub.docker.com')
+BASE_URL = HUB_URL + "/v2/repositories/{user}/{image}/"
 DOCKERFILE_URL = BASE_URL + "dockerfile/"
 
+# How many names `get_docker_info` remembers
+DOCKER_INFO_CACHE_SIZE = 64 * 1024
+# How many dockerfiles `DockerfileBodies` keeps in memory when they are on disk
+DEFAULT_BODY_CACHE_SIZE = 1024
+EMPTY_SHA256 = index.dockerfile_hash('')
+
+
+class DockerHubError(Exception):
+    """
+    Dockerhub would not give us a dockerfile, and there is no copy of it
+    """
+
+
+class _DockerInfo:
+    """
+    The parts of an image name, see `DockerImage.get_docker_info`
+
+    The same users, images and tags come up over and over in a big graph, so
+    they are interned
+    """
+    __slots__ = ('user', 'image', 'ref', 'tag', 'key')
+
+    def __init__(self, user, image, tag):
+        self.user = sys.intern(user)
+        self.image = sys.intern(image)
+        self.ref = self.tag = sys.intern(tag)  # TODO remove ref
+        # Different ways of writing the same image have the same key
+        self.key = sys.intern('{user}/{image}:{tag}'.format(user='_' if user == 'library' else user, image=image, tag=tag))
+
+
+class _NoChildren(collections.abc.MutableMapping):
+    """
+    The children of an image that has none yet, so every leaf doesn't need a
+    dict. Adding one gives the image a dict of its own.
+    """
+    __slots__ = ('image',)
+
+    def __init__(self, image):
+        self.image = image
+
+    def __getitem__(self, name):
+        if self.image._children is None:
+            raise KeyError(name)
+        return self.image._children[name]
+
+    def __setitem__(self, name, child):
+        if self.image._children is None:
+            self.image._children = {}
+        self.image._children[name] = child
+
+    def __delitem__(self, name):
+        if self.image._children is None:
+            raise KeyError(name)
+        del self.image._children[name]
+
+    def __iter__(self):
+        return iter(self.image._children or ())
+
+    def __len__(self):
+        return len(self.image._children or ())
+
+
+class DockerfileBodies:
+    """
+    The text of every dockerfile, stored once by its sha256 however many
+    images have the same one
+
+    With `folder` the texts are written there and read back when they are
+    asked for, only the `cache_size` most recently used are kept in memory.
+    Otherwise they are all kept in memory.
+    """
+    def __init__(self, folder=None, cache_size=DEFAULT_BODY_CACHE_SIZE):
+        self.folder = folder
+        self.cache_size = cache_size
+        self._texts = {}  # sha256 -> text, in the order they were used
+        self._lock = threading.Lock()
+
+    def _path(self, sha256):
+        return os.path.join(self.folder, sha256)
+
+    def _remember(self, sha256, text):
+        if self.folder is None:
+            self._texts[sha256] = text
+            return
+        # Most recently used last
+        self._texts.pop(sha256, None)
+        self._texts[sha256] = text
+        while len(self._texts) > self.cache_size:
+            del self._texts[next(iter(self._texts))]
+
+    def put(self, text):
+        """
+        Store `text`, returns the sha256 to get it back with
+        """
+        # Interned so every image with this dockerfile shares the one string
+        sha256 = sys.intern(index.dockerfile_hash(text))
+        with self._lock:
+            if sha256 in self._texts:
+                return sha256
+            if self.folder is not None and not os.path.exists(self._path(sha256)):
+                os.makedirs(self.folder, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=self.folder)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                os.replace(tmp, self._path(sha256))
+            self._remember(sha256, text)
+        return sha256
+
+    def get(self, sha256):
+        with self._lock:
+            text = self._texts.get(sha256)
+            if text is not None:
+                if self.folder is not None:
+                    self._remember(sha256, text)
+                return text
+        if self.folder is None:
+            raise KeyError(sha256)
+        with open(self._path(sha256)) as f:
+            text = f.read()
+        with self._lock:
+            self._remember(sha256, text)
+        return text
+
+    def __len__(self):
+        with self._lock:
+            return len(self._texts)
+
+
 class DockerImage:
+    """
+    A node in the graph of images, built on `parent`
+
+    Nodes are kept small so graphs of a lot of images fit in memory: there
+    is no `__dict__`, the dockerfile is only a hash into `dockerfile_bodies`
+    and images without children don't have a dict for them.
+    """
+    __slots__ = ('name', '_dockerfile_sha256', '_children', '_parent', '_lineage', '_segment')
+
+    # Set to `None` to always go out to dockerhub
+    dockerfile_cache = cache.DockerfileCache()
+    # All requests to dockerhub go through this
+    http = transport.default_transport
+    # Where parents are remembered between runs, `None` to not remember them
+    lineage_index = index.LineageIndex()
+    # Where the text of the dockerfiles is kept
+    dockerfile_bodies = DockerfileBodies()
+
     def __init__(self, name, dockerfile = None, children = None, parent = None):
         self.name = name
-        self.dockerfile = dockerfile if dockerfile else ""
-        self.children = children if children else {}
-        self.parent = parent if parent else None
+        self._dockerfile_sha256 = None
+        self._children = dict(children) if children else None
+        self._parent = None
+        self._lineage = None
+        self._segment = None
+        self.dockerfile = dockerfile
+        self.parent = parent
 
     def __repr__(self):
         return "<DockerImage {name}>".format(name=self.name)
 
+    @property
+    def dockerfile(self):
+        if self._dockerfile_sha256 is None:
+            return ""
+        return self.dockerfile_bodies.get(self._dockerfile_sha256)
+
+    @dockerfile.setter
+    def dockerfile(self, text):
+        self._dockerfile_sha256 = self.dockerfile_bodies.put(text) if text else None
+        self._segment = None
+
+    @property
+    def dockerfile_sha256(self):
+        """
+        The sha256 of `dockerfile`, without getting the text
+        """
+        return self._dockerfile_sha256 or EMPTY_SHA256
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        self._lineage = None
+
+    @property
+    def children(self):
+        """
+        The images built on this one by name
+        """
+        return self._children if self._children is not None else _NoChildren(self)
+
+    @children.setter
+    def children(self, children):
+        self._children = dict(children) if children else None
+
+    def add_child(self, child):
+        self.children[child.name] = child
+
     def is_root(self):
         return True if self.parent else False
 
     def get_lineage(self):
         """
-        Return a list of the images between the root and this image
+        Return a tuple of the images between the root and this image
+
+        The lineage of an image with children is kept, since every image
+        built on it starts with it, so a lineage is only walked up to the
+        nearest ancestor that has one. Changing the parent of an image starts
+        over for it, but not for images already built on it.
+        """
+        if self._lineage is not None:
+            return self._lineage
+        chain = []
+        seen = set()
+        image = self
+        while image is not None and image._lineage is None:
+            if id(image) in seen:
+                raise ValueError("{name} is built from itself".format(name=image.name))
+            seen.add(id(image))
+            chain.append(image)
+            image = image._parent
+        lineage = image._lineage if image is not None else ()
+        for ancestor in lineage:
+            if id(ancestor) in seen:
+                raise ValueError("{name} is built from itself".format(name=ancestor.name))
+        for image in reversed(chain):
+            lineage += (image,)
+            if image._children:
+                image._lineage = lineage
+        return lineage
+
+    def get_segment(self):
+        """
+        The part of a monolithic dockerfile that comes from this image
+
+        It is only rendered once, so images that share this one as an
+        ancestor all reuse the same text
         """
-        if self.parent:
-            return [*self.parent.get_lineage(), self]
-        else:
-            return [self]
+        if self._segment is None:
+            self._segment = "### {name} --- {date}\n{dockerfile}\n".format(
+                name=self.name, date=str(datetime.datetime.now()), dockerfile=self.dockerfile)
+        return self._segment
+
+    def get_monolith(self):
+        """
+        Yield the pieces of the concatenation of all the dockerfiles from the
+        root down to this image
+        """
+        for image in self.get_lineage():
+            yield image.get_segment()
+
+    @classmethod
+    def _check_cache(cls, info):
+        """
+        Look `info` up in the dockerfile cache
+
+        Returns the cached text if it can be used as is, otherwise the cache
+        key, the stale entry (if any) and the headers to revalidate it with
+        """
+        dockerfile_cache = cls.dockerfile_cache
+        if dockerfile_cache is None:
+            return None, None, None, {}
+        key = dockerfile_cache.key(info.user, info.image, info.tag)
+        entry, fresh = dockerfile_cache.lookup(key)
+        if fresh:
+            logging.debug("Cache hit for %s", key)
+            tracing.count('dockerfile_cache_hits')
+            return dockerfile_cache.read(key), key, entry, {}
+        tracing.count('dockerfile_cache_misses')
+        headers = dockerfile_cache.conditional_headers(entry) if entry is not None else {}
+        return None, key, entry, headers
+
+    @classmethod
+    def _handle_response(cls, info, key, entry, status_code, headers, body):
+        """
+        Turn a response from dockerhub into the dockerfile text, updating the cache
+        `body` is the decoded json, only needed for a 200
+        """
+        dockerfile_cache = cls.dockerfile_cache
+        if status_code == 304 and entry is not None:
+            logging.debug("Cached dockerfile for {key} is still valid".format(key=key))
+            dockerfile_cache.revalidated(key)
+            return dockerfile_cache.read(key)
+        # Didnt get a file, 404
+        if status_code == 404:
+            logging.warning("Could not find dockerfile for '{user}/{image}'".format(user=info.user, image=info.image))
+            if dockerfile_cache is not None:
+                # Remember that there is nothing there so we don't ask again
+                dockerfile_cache.put(key, '')
+            return ''
+        elif status_code != 200:
+            logging.warning("Did not get 200 status code for {user}/{image}; {rst}".format(user=info.user, image=info.image, rst=status_code))
+            if entry is not None:
+                # Stale is better than nothing
+                return dockerfile_cache.read(key)
+            # Going on without it would make this look like a root and cut the lineage short
+            raise DockerHubError("Could not get the dockerfile for {user}/{image}, dockerhub said {status}".format(
+                user=info.user, image=info.image, status=status_code))
+        logging.debug("request complete")
+        logging.debug(body)
+        text = body['contents'] or ''
+
+        logging.debug("complete: ---")
+        logging.debug(text)
+        logging.debug("---")
+        if dockerfile_cache is not None:
+            dockerfile_cache.put(key, text,
+                                 etag=headers.get('ETag'),
+                                 last_modified=headers.get('Last-Modified'))
+        return text
 
     @classmethod
     def get_dockerfile(cls, name):
@@ -44,30 +354,51 @@ class DockerImage:
 
            Attempt to get the dockerfile and return the text
         """
-        logging.debug('getting: ' + name)
+        with tracing.span('get_dockerfile', image=name):
+            logging.debug('getting: %s', name)
+            info = cls.get_docker_info(name)
+            logging.debug('User: %s; Image: %s; Tag: %s', info.user, info.image, info.tag)
+
+            # Check the cache before going out to dockerhub
+            text, key, entry, headers = cls._check_cache(info)
+            if text is not None:
+                return text
+
+            # TODO figure out tag as well
+            # Make a call out to get the page
+            logging.debug("Getting from dockerhub")
+            result = cls.http.get(DOCKERFILE_URL.format(user=info.user, image=info.image), headers=headers)
+            body = result.json() if result.status_code == 200 else None
+            # Return the text
+            return cls._handle_response(info, key, entry, result.status_code, result.headers, body)
+
+    @classmethod
+    async def get_dockerfile_async(cls, name, session=None, timeout=30):
+        """
+        The same as `get_dockerfile` but for use with asyncio
+
+        `session` is an `aiohttp.ClientSession`, one is made for this call if
+        it is not given. `timeout` is in seconds for the whole request.
+        """
+        import aiohttp  # Only needed for the async api
+
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await cls.get_dockerfile_async(name, session=session, timeout=timeout)
+
+        # The cache is on disk, keep it off the event loop
+        loop = asyncio.get_event_loop()
         info = cls.get_docker_info(name)
-        logging.debug('User: {user}; Image: {image}; Tag: {tag}'.format(user=info.user, image=info.image, tag=info.tag))
+        text, key, entry, headers = await loop.run_in_executor(None, cls._check_cache, info)
+        if text is not None:
+            return text
 
-        # TODO figure out tag as well
-        # Make a call out to get the page
         logging.debug("Getting from dockerhub")
-        result = requests.get(DOCKERFILE_URL.format(user=info.user, image=info.image))
-        # Didnt get a file, 404
-        if result.status_code == 404:
-            logging.warning("Could not find dockerfile for '{user}/{image}'".format(user=info.user, image=info.image))
-            return ''
-        elif result.status_code != 200:
-            logging.warning("Did not get 200 status code for {user}/{image}; {rst}".format(user=info.user, image=info.image, rst=result.status_code))
-            return ''
-        logging.debug("request complete")
-        logging.debug(result.json())
-        text = result.json()['contents']
-
-        logging.debug("complete: ---")
-        logging.debug(text)
-        logging.debug("---")
-        # Return the text
-        return text or ''
+        # Rate limited and retried the same as `get_dockerfile`
+        url = DOCKERFILE_URL.format(user=info.user, image=info.image)
+        result = await cls.http.request_async(session, 'GET', url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout))
+        body = await result.json(content_type=None) if result.status == 200 else None
+        return await loop.run_in_executor(None, cls._handle_response, info, key, entry, result.status, result.headers, body)
 
     @staticmethod
     def get_from(dockerfile):
@@ -79,29 +410,183 @@ class DockerImage:
         return re.search(regex, dockerfile, re.MULTILINE).groups()[0]
 
     @classmethod
-    def get_tree(cls, name):
-        curr_img = cls(name=name)
+    def get_parent(cls, name):
+        """
+        Get the dockerfile of `name` and the name of the image it is built from
+        """
         dockerfile = cls.get_dockerfile(name)
-        curr_img.dockerfile = dockerfile
-        m = parsers.DockerFileToSingularityFile(name)
-        m.parse(dockerfile)
-        while dockerfile:
-            name = m.image  # Get the next image name
-            new_img = cls(name=name)
-
-            # Update references
-            curr_img.parent = new_img
-            new_img.children[curr_img.name] = curr_img
-            curr_img = new_img
-
-            # Get next iteration
-            dockerfile = cls.get_dockerfile(name)
+        parent_name = parsers.DockerFileToSingularityFile.get_base_image(dockerfile)
+        cls._record(name, dockerfile, parent_name)
+        return dockerfile, parent_name
+
+    @classmethod
+    def _record(cls, name, dockerfile, parent_name):
+        """
+        Save the parent of `name` in the lineage index
+        """
+        if cls.lineage_index is None:
+            return
+        if not dockerfile or not parent_name:
+            parent_name = None
+        key = cls.get_docker_info(name).key
+        parent = cls.get_docker_info(parent_name).key if parent_name else None
+        if parent == key:
+            # Not a lineage that can be built, don't let it into the index
+            logging.warning("`%s` is built FROM itself, not recording it", name)
+            return
+        cls.lineage_index.record(key, name, parent, parent_name, dockerfile)
+
+    @classmethod
+    def get_tree(cls, name):
+        with tracing.span('get_tree', image=name):
+            curr_img = cls(name=name)
+            dockerfile, name = cls.get_parent(name)
             curr_img.dockerfile = dockerfile
-            m = parsers.DockerFileToSingularityFile(name)
-            m.parse(dockerfile)
+            while dockerfile:
+                new_img = cls(name=name)
+
+                # Update references
+                curr_img.parent = new_img
+                new_img.add_child(curr_img)
+                curr_img = new_img
+
+                # Get next iteration
+                dockerfile, name = cls.get_parent(name)
+                curr_img.dockerfile = dockerfile
+            return curr_img
+
+    @classmethod
+    def get_tree_indexed(cls, name, max_workers=8):
+        """
+        The same as `get_tree`, but if the lineage of `name` is in the lineage
+        index all of its dockerfiles are fetched at once
+        """
+        curr_img = cls.get_forest([name], max_workers=max_workers)[name]
+        while curr_img.parent:
+            curr_img = curr_img.parent
+        return curr_img
+
+    @classmethod
+    def get_forest(cls, names, max_workers=8):
+        """
+        Get the trees of many images at once
+
+        The lineages are walked concurrently and every distinct image is only
+        fetched and parsed once, so images with a common base share the same
+        node. Returns a dict of each name in `names` to its node, follow
+        `parent` (or use `get_lineage`) to get to the roots.
+
+        Parents already in the lineage index are fetched right away instead of
+        waiting for the child's dockerfile, so a known lineage is fetched all
+        at once rather than one level at a time. If an image turns out to
+        have a different parent now, the guess is just not used.
+        """
+        with tracing.span('get_forest', images=len(names)):
+            nodes = {}  # Normalized name -> node
+            futures = {}  # Future -> normalized name
+
+            def submit(name):
+                key = first = cls.get_docker_info(name).key
+                # Follow what the index knows about the lineage
+                while name is not None and key not in nodes:
+                    nodes[key] = cls(name=name)
+                    futures[pool.submit(cls.get_parent, name)] = key
+                    name = cls.lineage_index.get_parent(key) if cls.lineage_index is not None else None
+                    if name is not None:
+                        key = cls.get_docker_info(name).key
+                return nodes[first]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+                requested = {name: submit(name) for name in names}
+                while futures:
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        key = futures.pop(future)
+                        node = nodes[key]
+                        dockerfile, parent_name = future.result()
+                        node.dockerfile = dockerfile
+                        if not dockerfile:
+                            continue
+                        parent = submit(parent_name)
+                        if parent is node:
+                            logging.warning("{name} is built from itself".format(name=node.name))
+                            continue
+                        node.parent = parent
+                        parent.add_child(node)
+            return requested
+
+    @classmethod
+    async def get_forest_async(cls, names, max_concurrency=32, timeout=30, session=None):
+        """
+        The same as `get_forest` but for use with asyncio
+
+        At most `max_concurrency` requests are out at once and each one has
+        `timeout` seconds to finish. If this is cancelled, every outstanding
+        request is cancelled as well.
+        """
+        import aiohttp  # Only needed for the async api
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        nodes = {}  # Normalized name -> node
+        tasks = {}  # Task -> normalized name
+
+        async def get_parent(name):
+            async with semaphore:
+                dockerfile = await cls.get_dockerfile_async(name, session=session, timeout=timeout)
+            parent_name = parsers.DockerFileToSingularityFile.get_base_image(dockerfile)
+            # Writes to the lineage index
+            await asyncio.get_event_loop().run_in_executor(None, cls._record, name, dockerfile, parent_name)
+            return dockerfile, parent_name
+
+        def submit(name):
+            key = cls.get_docker_info(name).key
+            if key not in nodes:
+                nodes[key] = cls(name=name)
+                tasks[asyncio.ensure_future(get_parent(name))] = key
+            return nodes[key]
+
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_concurrency))
+        try:
+            requested = {name: submit(name) for name in names}
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key = tasks.pop(task)
+                    node = nodes[key]
+                    dockerfile, parent_name = task.result()
+                    node.dockerfile = dockerfile
+                    if not dockerfile:
+                        continue
+                    parent = submit(parent_name)
+                    if parent is node:
+                        logging.warning("{name} is built from itself".format(name=node.name))
+                        continue
+                    node.parent = parent
+                    parent.add_child(node)
+            return requested
+        finally:
+            # Cancelled or something failed, don't leave anything running
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if own_session:
+                await session.close()
+
+    @classmethod
+    async def get_tree_async(cls, name, max_concurrency=32, timeout=30, session=None):
+        """
+        The same as `get_tree` but for use with asyncio
+        """
+        curr_img = (await cls.get_forest_async([name], max_concurrency=max_concurrency, timeout=timeout, session=session))[name]
+        while curr_img.parent:
+            curr_img = curr_img.parent
         return curr_img
 
     @staticmethod
+    @functools.lru_cache(maxsize=DOCKER_INFO_CACHE_SIZE)
     def get_docker_info(name):
         """
         Given a name of the form
@@ -113,7 +598,7 @@ class DockerImage:
         image@sha256:digest
         user/image@sha256:digest
 
-        make an object that represents it
+        make an object that represents it, the same one every time
         """
         # Get everything in the form given in the docstring. Include characters, digits, and '-'
         # Note that the ref needs the `sha256:` bit, so it also needs the `:` in the capture group
@@ -132,14 +617,6 @@ class DockerImage:
             user = '_'
         if tag is None:
             tag = 'latest'
-        
-        class _DockerInfo:
-            def __init__(self, user, image, tag):
-                self.user = user
-                self.image = image
-                self.ref = tag  # TODO remove this
-                self.tag = tag
-        
         return _DockerInfo(user=user, image=image, tag=tag)
 
     def gen_name(self):
@@ -0,0 +1,159 @@
+"""
+Persistent index of which image each image is built from
+
+Every time a dockerfile is fetched its parent, the sha256 of the dockerfile
+and when it was fetched are recorded in a SQLite database, so questions like
+"what is built on nvidia/cuda:8.0" can be answered without crawling dockerhub
+again.
+
+    python -m monolith.index descendants nvidia/cuda:8.0
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_INDEX_PATH = os.environ.get('MONOLITH_INDEX_PATH',
+                                    os.path.join(os.path.expanduser('~'), '.cache', 'monolith', 'lineage.db'))
+DEFAULT_MAX_AGE = 24 * 60 * 60  # One day
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    parent TEXT,
+    parent_name TEXT,
+    dockerfile_sha256 TEXT,
+    fetched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_parent ON images (parent);
+"""
+
+# `path` is every key visited so far, so a cycle stops instead of recursing forever
+ANCESTORS_QUERY = """
+WITH RECURSIVE ancestors(key, depth, path) AS (
+    SELECT parent, 1, '|' || key || '|' || parent || '|' FROM images WHERE key = ?1 AND parent IS NOT NULL AND parent != key
+    UNION ALL
+    SELECT images.parent, ancestors.depth + 1, ancestors.path || images.parent || '|'
+    FROM images JOIN ancestors ON images.key = ancestors.key
+    WHERE images.parent IS NOT NULL AND instr(ancestors.path, '|' || images.parent || '|') = 0
+)
+SELECT images.key, images.name, images.parent, images.parent_name, images.dockerfile_sha256, images.fetched
+FROM ancestors JOIN images ON images.key = ancestors.key
+ORDER BY ancestors.depth
+"""
+
+DESCENDANTS_QUERY = """
+WITH RECURSIVE descendants(key, depth, path) AS (
+    SELECT key, 1, '|' || ?1 || '|' || key || '|' FROM images WHERE parent = ?1 AND key != ?1
+    UNION ALL
+    SELECT images.key, descendants.depth + 1, descendants.path || images.key || '|'
+    FROM images JOIN descendants ON images.parent = descendants.key
+    WHERE instr(descendants.path, '|' || images.key || '|') = 0
+)
+SELECT images.key, images.name, images.parent, images.parent_name, images.dockerfile_sha256, images.fetched
+FROM descendants JOIN images ON images.key = descendants.key
+ORDER BY descendants.depth, images.key
+"""
+
+
+def dockerfile_hash(dockerfile):
+    return hashlib.sha256(dockerfile.encode()).hexdigest()
+
+
+class LineageIndex:
+    """
+    Images are stored by their key (`user/image:tag`, see `DockerImage.get_docker_info`)
+    along with the key and name of their parent, or None for a root.
+    Entries older than `max_age` seconds are not trusted by `get_parent`.
+    """
+    COLUMNS = ('key', 'name', 'parent', 'parent_name', 'dockerfile_sha256', 'fetched')
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        """
+        Lazily connect so creating an index never touches the disk
+        """
+        if self._connection is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # Used from the threads in `DockerImage.get_forest`, everything goes through `_lock`
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def _rows(self, query, *params):
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def record(self, key, name, parent, parent_name, dockerfile):
+        """
+        Remember that `key` is built from `parent`, `parent` is None for a root
+        """
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                (key, name, parent, parent_name, dockerfile_hash(dockerfile), time.time()))
+
+    def get(self, key):
+        rows = self._rows('SELECT * FROM images WHERE key = ?', key)
+        return rows[0] if rows else None
+
+    def get_parent(self, key):
+        """
+        The name of the image `key` is built from if it is known and recent
+        enough to be trusted, otherwise None
+        """
+        entry = self.get(key)
+        if entry is None or time.time() - entry['fetched'] > self.max_age:
+            return None
+        return entry['parent_name']
+
+    def ancestors(self, key):
+        """
+        The entries for every image `key` is built on, nearest first
+        """
+        return self._rows(ANCESTORS_QUERY, key)
+
+    def descendants(self, key):
+        """
+        The entries for every image built on `key`, directly or not, nearest first
+        """
+        return self._rows(DESCENDANTS_QUERY, key)
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+if __name__ == '__main__':
+    try:
+        import image_types
+    except ModuleNotFoundError:
+        import monolith.image_types as image_types
+
+    parser = argparse.ArgumentParser(description="Query the lineage index")
+    parser.add_argument('--index', help="The index to look in", default=DEFAULT_INDEX_PATH)
+    parser.add_argument('query', choices=['ancestors', 'descendants'])
+    parser.add_argument('image_name', type=str, help="The name of the Docker image, as such: 'nvidia/cuda:8.0'")
+    args = parser.parse_args()
+
+    index = LineageIndex(args.index)
+    key = image_types.DockerImage.get_docker_info(args.image_name).key
+    for entry in getattr(index, args.query)(key):
+        print(entry['key'])
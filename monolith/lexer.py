@@ -0,0 +1,235 @@
+"""
+Split the text of a dockerfile into instructions
+
+This is done in a single pass over the lines of the file so the time it takes
+only grows with the size of the file, no matter how long the continuation
+blocks get.
+"""
+import collections
+import hashlib
+import logging
+import re
+import threading
+
+DIRECTIVE_REGEX = re.compile(r'^\s*#\s*(\w+)\s*=\s*(\S+)\s*$')
+INSTRUCTION_REGEX = re.compile(r'^\s*([A-Za-z]\w*)(?:\s+|$)')
+# `<<EOF`, `<<-EOF` or `<<"EOF"`, but not `<<<word`
+HEREDOC_REGEX = re.compile(r'<<(?!<)(-?)(["\']?)([A-Za-z_]\w*)\2')
+# What a heredoc can come right after, so `$((1<<FOO))` isn't one
+WORD_START = ' \t;&|('
+COMMENT_REGEX = re.compile(r'^\s*#')
+# Only these can have heredocs
+HEREDOC_INSTRUCTIONS = {'RUN', 'COPY', 'ADD'}
+# Handed to the shell (or are JSON), the escape character only continues their lines
+SHELL_INSTRUCTIONS = {'RUN', 'CMD', 'ENTRYPOINT', 'SHELL', 'HEALTHCHECK'}
+
+
+def get_directives(lines):
+    """
+    Read the parser directives at the top of the file, ie.
+
+    # escape=`
+
+    Returns the directives and the number of lines they took up
+    """
+    directives = {}
+    for number, line in enumerate(lines):
+        m = DIRECTIVE_REGEX.match(line)
+        if not m or m.group(1).lower() in directives:
+            return directives, number
+        directives[m.group(1).lower()] = m.group(2)
+    return directives, len(lines)
+
+
+def find_heredocs(line, escape, quote=None):
+    """
+    Return the `(strip_tabs, quote, terminator)` of each heredoc on `line`
+    and the quote that is still open at the end of it, to pass in with the
+    next line of the instruction. Only a `<<WORD` that starts a word outside
+    of quotes is a heredoc.
+    """
+    heredocs = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if quote is not None:
+            if c == quote:
+                quote = None
+            elif c == escape and quote == '"':
+                i += 1
+        elif c == escape:
+            i += 1
+        elif c in '\'"':
+            quote = c
+        elif c == '<' and (i == 0 or line[i - 1] in WORD_START):
+            m = HEREDOC_REGEX.match(line, i)
+            if m:
+                heredocs.append(m.groups())
+                i = m.end()
+                continue
+            while i < len(line) and line[i] == '<':
+                i += 1
+            continue
+        i += 1
+    return heredocs, quote
+
+
+def translate_escapes(text, escape):
+    """
+    Rewrite `text` written with `escape` as the escape character so it uses `\\`
+    like the rest of monolith expects. Single quoted text is left as it is.
+    """
+    translated = []
+    quote = None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote == "'":
+            if c == "'":
+                quote = None
+            translated.append(c)
+        elif c == escape and i + 1 < len(text):
+            i += 1
+            translated.append('\\' + text[i])
+        elif c == '\\':
+            translated.append('\\\\')
+        else:
+            if c in '\'"' and quote is None:
+                quote = c
+            elif c == quote:
+                quote = None
+            translated.append(c)
+        i += 1
+    return ''.join(translated)
+
+
+def continue_with_backslash(line, escape):
+    """
+    `line` ending in a `\\` instead of `escape`, so the shell can follow it
+    """
+    stripped = line.rstrip()
+    if escape == '\\' or not stripped.endswith(escape):
+        return line
+    return stripped[:-1] + '\\'
+
+
+def tokenize(code):
+    """
+    Yield `(instruction, params, first_line, last_line)` for every instruction
+    in `code`. Line numbers start at 1.
+
+    `params` is everything after the instruction up to the end of the
+    instruction, including any continuation lines and heredocs. Comments and
+    empty lines inside of a continuation are dropped. It always ends with a
+    newline.
+
+    With an `# escape=` directive the params are rewritten to escape with `\\`,
+    see `translate_escapes`.
+    """
+    lines = [line.rstrip('\r') for line in code.split('\n')]
+    directives, number = get_directives(lines)
+    escape = directives.get('escape', '\\')
+
+    while number < len(lines):
+        line = lines[number]
+        number += 1
+        if not line.strip() or COMMENT_REGEX.match(line):
+            continue
+        m = INSTRUCTION_REGEX.match(line)
+        if not m:
+            logging.warning("Could not find an instruction on line {number}: `{line}`".format(number=number, line=line))
+            continue
+        first_line = number
+        inst = m.group(1).upper()
+        params = [line[m.end():]]
+        has_heredocs = inst in HEREDOC_INSTRUCTIONS
+        heredocs, quote = find_heredocs(params[0], escape) if has_heredocs else ([], None)
+
+        # Follow the continuation lines
+        continued = line.rstrip().endswith(escape)
+        while continued and number < len(lines):
+            line = lines[number]
+            number += 1
+            if not line.strip() or COMMENT_REGEX.match(line):
+                continue
+            params.append(line)
+            if has_heredocs:
+                found, quote = find_heredocs(line, escape, quote)
+                heredocs.extend(found)
+            continued = line.rstrip().endswith(escape)
+
+        if escape != '\\':
+            if inst in SHELL_INSTRUCTIONS:
+                params = [continue_with_backslash(line, escape) for line in params]
+            else:
+                params = [translate_escapes('\n'.join(params), escape)]
+
+        # Everything up to each terminator is part of the instruction
+        for strip_tabs, _, terminator in heredocs:
+            while number < len(lines):
+                line = lines[number]
+                number += 1
+                params.append(line)
+                if (line.lstrip('\t') if strip_tabs else line) == terminator:
+                    break
+
+        yield inst, '\n'.join(params) + '\n', first_line, number
+
+
+class Instruction:
+    """
+    One instruction of a dockerfile and the lines it came from
+    """
+    __slots__ = ('instruction', 'params', 'first_line', 'last_line')
+
+    def __init__(self, instruction, params, first_line, last_line):
+        self.instruction = instruction
+        self.params = params
+        self.first_line = first_line
+        self.last_line = last_line
+
+    def __repr__(self):
+        return "<Instruction {instruction} lines {first_line}-{last_line}>".format(instruction=self.instruction,
+                                                                                first_line=self.first_line,
+                                                                                last_line=self.last_line)
+
+    def __iter__(self):
+        # So it can be unpacked like the tuples from `tokenize`
+        return iter((self.instruction, self.params, self.first_line, self.last_line))
+
+
+# Parsed dockerfiles, keyed by the hash of their text
+INSTRUCTION_CACHE_SIZE = 4096
+_instruction_cache = collections.OrderedDict()
+_instruction_cache_lock = threading.Lock()
+
+
+def clear_cache():
+    with _instruction_cache_lock:
+        _instruction_cache.clear()
+
+
+def content_hash(code):
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def get_instructions(code):
+    """
+    Return a tuple of the `Instruction`s in `code`
+
+    The result is remembered by the hash of `code`, so the same dockerfile is
+    only ever tokenized once no matter how many times it is asked for.
+    """
+    key = content_hash(code)
+    with _instruction_cache_lock:
+        instructions = _instruction_cache.get(key)
+        if instructions is not None:
+            _instruction_cache.move_to_end(key)
+            return instructions
+
+    instructions = tuple(Instruction(*token) for token in tokenize(code))
+    with _instruction_cache_lock:
+        _instruction_cache[key] = instructions
+        while len(_instruction_cache) > INSTRUCTION_CACHE_SIZE:
+            _instruction_cache.popitem(last=False)
+    return instructions
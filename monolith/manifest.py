@@ -0,0 +1,69 @@
+"""
+Remember what every output was generated from, so outputs whose lineage has
+not changed don't have to be generated again
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+MANIFEST_NAME = '.monolith-manifest.json'
+
+
+def lineage_hash(lineage, options):
+    """
+    A hash of the name and dockerfile of every image in `lineage` and of the
+    options used to generate the output from them
+    """
+    h = hashlib.sha256()
+    for image in lineage:
+        h.update('{name}\0{sha256}\0'.format(name=image.name, sha256=image.dockerfile_sha256).encode())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class BuildManifest:
+    """
+    `MANIFEST_NAME` in `folder` maps each output file in it to the hash of
+    what it was generated from, along with the lineage and options that went
+    into it so it is easy to see why something was regenerated.
+    """
+    def __init__(self, folder):
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.folder = folder
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _key(self, filename):
+        return os.path.relpath(filename, self.folder)
+
+    def is_current(self, filename, digest, outputs=()):
+        """
+        Is `filename` (and every other file in `outputs`) there and generated from `digest`
+        """
+        entry = self.entries.get(self._key(filename))
+        if entry is None or entry['hash'] != digest:
+            return False
+        return all(os.path.exists(output) for output in [filename, *outputs])
+
+    def record(self, filename, digest, lineage, options):
+        with self._lock:
+            self.entries[self._key(filename)] = {
+                'hash': digest,
+                'lineage': [[image.name, image.dockerfile_sha256] for image in lineage],
+                'options': options,
+                'generated': time.time()}
+
+    def save(self):
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.folder)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
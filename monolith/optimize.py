@@ -0,0 +1,334 @@
+"""
+Make %post faster to build by cutting out work the flattened lineage repeats
+
+Every image in a lineage does its own `apt-get update`, installs its own
+packages and cleans up after itself. Once they are all in one %post most of
+that is redundant:
+
+* `apt-get update` only has to happen again if the package sources changed
+* the apt lists and archives are only cleaned up once, at the end
+* `apt-get install` and `pip install` right after each other become one
+  install (unless they want different versions of a package), and packages
+  that are already installed are not installed again
+* RUNs right after each other become one shell block
+
+Anything that is not a plain `cmd && cmd && ...` chain is left alone, and is
+treated as if it could have changed the package sources.
+"""
+import collections
+import logging
+import re
+import shlex
+
+# Rough seconds each thing takes during a build, for the estimate of time saved
+APT_UPDATE_SECONDS = 20
+APT_INSTALL_SECONDS = 10
+PIP_INSTALL_SECONDS = 5
+CLEANUP_SECONDS = 1
+
+APT_LISTS_CLEANUP = 'rm -rf /var/lib/apt/lists/*'
+APT_COMMANDS = {'apt-get', 'apt'}
+PIP_COMMANDS = {'pip', 'pip2', 'pip3'}
+# Options that don't take an argument, so the rest of the words are packages
+APT_FLAGS = {'-y', '--yes', '-q', '-qq', '--quiet', '--no-install-recommends', '--no-install-suggests',
+             '--allow-unauthenticated', '--allow-downgrades', '--fix-missing', '-f'}
+PIP_FLAGS = {'--no-cache-dir', '-q', '--quiet', '--user', '--no-deps', '--pre', '--no-compile',
+             '--disable-pip-version-check', '--ignore-installed', '-I', '--force-reinstall'}
+PIP_UPGRADE_FLAGS = {'-U', '--upgrade'}
+SHELL_EXPANSIONS = '$`*?~{['
+# Anything that might change what `apt-get update` would get
+APT_SOURCES_HINTS = ('sources.list', 'add-apt-repository', 'apt-key', '/etc/apt', '/var/lib/apt/lists',
+                     'dpkg', 'apt-get remove', 'apt-get purge', 'apt-get autoremove')
+
+
+class RunCommand(str):
+    """
+    A RUN as it goes into %post, marked so the optimizer can find it
+    """
+    def __new__(cls, command):
+        self = super().__new__(cls, '\n    ' + command)
+        self.command = command
+        return self
+
+
+def split_commands(command):
+    """
+    Split a shell command into the commands of its `&&` chain
+
+    Returns None if it is anything more complicated than that (`;`, `||`,
+    pipes, subshells, redirects, heredocs or comments)
+    """
+    commands = []
+    current = []
+    quote = None
+    i = 0
+    while i < len(command):
+        c = command[i]
+        if quote:
+            if c == '\\' and quote == '"':
+                current.append(command[i:i + 2])
+                i += 2
+                continue
+            if c == quote:
+                quote = None
+            elif c == '$' and command[i + 1:i + 2] == '(' and quote == '"':
+                return None
+            current.append(c)
+        elif c == '\\':
+            if command[i + 1:i + 2] == '\n':
+                # Line continuation
+                current.append(' ')
+            else:
+                current.append(command[i:i + 2])
+            i += 2
+            continue
+        elif c in '\'"':
+            quote = c
+            current.append(c)
+        elif command.startswith('&&', i):
+            commands.append(''.join(current).strip())
+            current = []
+            i += 2
+            continue
+        elif c in ';|&<>()`#\n' or command.startswith('$(', i):
+            if c == '\n' and not command[i + 1:].strip():
+                break
+            return None
+        else:
+            current.append(c)
+        i += 1
+    if quote:
+        return None
+    commands.append(''.join(current).strip())
+    if not all(commands):
+        return None
+    return commands
+
+
+def package_name(package):
+    """
+    `numpy` for `numpy==1.0`, `NumPy[extra]>=1` or `numpy=1:1.0-1` (apt)
+    """
+    return re.split(r'[<>=!~\[;@\s]', package, 1)[0].lower().replace('_', '-')
+
+
+def conflicts(packages, others):
+    """
+    Does a package come up in both with different versions, so they can't be installed at once
+    """
+    names = {package_name(package): package for package in packages}
+    return any(names.get(package_name(package), package) != package for package in others)
+
+
+class Step:
+    """
+    One command of a RUN, with what it does if it is an apt or pip install
+    """
+    __slots__ = ('text', 'kind', 'key', 'packages', 'words')
+
+    def __init__(self, text):
+        self.text = text
+        self.kind = 'other'
+        self.key = None  # Installs with the same key can be merged
+        self.packages = []
+        try:
+            self.words = shlex.split(text)
+        except ValueError:
+            self.words = []
+        self._classify()
+
+    def _classify(self):
+        if self.text.strip() == APT_LISTS_CLEANUP:
+            self.kind = 'apt-cleanup'
+            return
+        if any(c in self.text for c in SHELL_EXPANSIONS):
+            # Can't tell what the packages are until the shell runs it
+            return
+        words = self.words
+        # `DEBIAN_FRONTEND=noninteractive apt-get ...`
+        prefix = []
+        while words and '=' in words[0] and not words[0].startswith('-'):
+            prefix.append(words[0])
+            words = words[1:]
+        if not words:
+            return
+        if words[0] in APT_COMMANDS and len(words) > 1:
+            options = [word for word in words[1:] if word.startswith('-')]
+            rest = [word for word in words[1:] if not word.startswith('-')]
+            if not all(option in APT_FLAGS for option in options):
+                return
+            if rest == ['update']:
+                self.kind = 'apt-update'
+            elif rest == ['clean']:
+                self.kind = 'apt-cleanup'
+            elif len(rest) > 1 and rest[0] == 'install':
+                self.kind = 'apt-install'
+                self.key = (tuple(prefix), words[0], tuple(sorted(options)))
+                self.packages = rest[1:]
+            return
+        if words[0] in PIP_COMMANDS:
+            command, words = [words[0]], words[1:]
+        elif words[0].startswith('python') and words[1:3] == ['-m', 'pip']:
+            command, words = words[:3], words[3:]
+        else:
+            return
+        if not words or words[0] != 'install':
+            return
+        options = [word for word in words[1:] if word.startswith('-')]
+        packages = [word for word in words[1:] if not word.startswith('-')]
+        if not packages or not all(option in PIP_FLAGS | PIP_UPGRADE_FLAGS for option in options):
+            return
+        if any('/' in package or package.startswith('.') for package in packages):
+            # Local paths and urls
+            return
+        self.kind = 'pip-install'
+        self.key = (tuple(prefix), tuple(command), tuple(sorted(options)))
+        self.packages = packages
+
+    def render(self):
+        """
+        The command again, after its packages have been changed
+        """
+        if self.kind not in ('apt-install', 'pip-install'):
+            return self.text
+        prefix, command, options = self.key
+        if isinstance(command, str):
+            command = (command,)
+        return ' '.join(shlex.quote(word) for word in [*prefix, *command, 'install', *options, *self.packages])
+
+
+class PostOptimizer:
+    """
+    Goes over %post once, keeping track of what apt and pip have already done
+    """
+    def __init__(self):
+        self.stats = collections.Counter()
+        self.updated = False  # Has `apt-get update` run since the sources last changed
+        self.apt_installed = set()
+        # pip, pip3 and `python3 -m pip` install for different interpreters
+        self.pip_installed = collections.defaultdict(set)  # Step key -> packages
+        self.cleanups = []  # The cleanups that were taken out, to do once at the end
+
+    def optimize_steps(self, steps):
+        """
+        Return the commands of a block with the redundant ones taken out
+        """
+        kept = []
+        for step in steps:
+            if step.kind == 'apt-update':
+                if self.updated:
+                    self.stats['apt_updates_dropped'] += 1
+                    continue
+                self.updated = True
+            elif step.kind == 'apt-cleanup':
+                # Done once at the end instead
+                self.stats['cleanups_dropped'] += 1
+                if step.text.strip() not in self.cleanups:
+                    self.cleanups.append(step.text.strip())
+                continue
+            elif step.kind == 'apt-install':
+                step.packages = [package for package in step.packages if package not in self.apt_installed]
+                self.apt_installed.update(step.packages)
+                if self._merge(kept, step, 'apt_installs_merged'):
+                    continue
+            elif step.kind == 'pip-install':
+                if not PIP_UPGRADE_FLAGS & set(step.key[2]):
+                    installed = self.pip_installed[step.key]
+                    step.packages = [package for package in step.packages if package not in installed]
+                    installed.update(step.packages)
+                if self._merge(kept, step, 'pip_installs_merged'):
+                    continue
+            else:
+                self.changed(step.text)
+            kept.append(step)
+        return [step.render() for step in kept]
+
+    def _merge(self, kept, step, stat):
+        """
+        Add the packages of `step` to the install before it if that is the
+        same kind of install, returns True if `step` is not needed anymore
+        """
+        if not step.packages:
+            self.stats[stat] += 1
+            return True
+        if kept and kept[-1].key == step.key and not conflicts(kept[-1].packages, step.packages):
+            kept[-1].packages.extend(package for package in step.packages if package not in kept[-1].packages)
+            self.stats[stat] += 1
+            return True
+        return False
+
+    def changed(self, text):
+        """
+        Something we don't understand ran, see if it could have changed what apt or pip know
+        """
+        if any(hint in text for hint in APT_SOURCES_HINTS):
+            self.updated = False
+            self.apt_installed.clear()
+        if 'pip' in text:
+            self.pip_installed.clear()
+
+    def optimize(self, post):
+        """
+        Return a new %post with the RUNs optimized
+        """
+        optimized = []
+        block = None  # The commands of the RUNs that are being collapsed together
+        comments = []  # Comments that go with whatever comes next
+
+        def flush():
+            if block is not None:
+                commands = self.optimize_steps([Step(command) for command in block])
+                if commands:
+                    optimized.append('\n    ' + ' && \\\n    '.join(commands) + '\n')
+
+        for entry in post:
+            if isinstance(entry, RunCommand):
+                commands = split_commands(entry.command)
+                if commands is not None:
+                    if block is not None:
+                        self.stats['runs_collapsed'] += 1
+                        block.extend(commands)
+                        # The comment was for the RUN, which is now part of the block
+                        comments = []
+                        continue
+                    optimized.extend(comments)
+                    comments = []
+                    block = commands
+                    continue
+                flush()
+                block = None
+                self.changed(entry.command)
+            elif entry.strip().startswith('#'):
+                comments.append(entry)
+                continue
+            else:
+                flush()
+                block = None
+            optimized.extend(comments)
+            comments = []
+            optimized.append(entry)
+        flush()
+        optimized.extend(comments)
+        if self.cleanups:
+            optimized.append('\n    # Cleaned up once at the end by monolith\n    ' + ' && \\\n    '.join(self.cleanups) + '\n')
+        return optimized
+
+    def seconds_saved(self):
+        """
+        A rough estimate of how much faster the build is
+        """
+        return (self.stats['apt_updates_dropped'] * APT_UPDATE_SECONDS
+                + self.stats['apt_installs_merged'] * APT_INSTALL_SECONDS
+                + self.stats['pip_installs_merged'] * PIP_INSTALL_SECONDS
+                + max(0, self.stats['cleanups_dropped'] - len(self.cleanups)) * CLEANUP_SECONDS)
+
+
+def optimize_post(post):
+    """
+    Return the optimized %post and a report of what was done
+    """
+    optimizer = PostOptimizer()
+    optimized = optimizer.optimize(post)
+    report = dict(optimizer.stats, seconds_saved=optimizer.seconds_saved())
+    logging.info("Optimized %post: {report}".format(report=report))
+    return optimized, report
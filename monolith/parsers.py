@@ -1,11 +1,71 @@
 import re
-import inspect
+import io
 import os
-import subprocess
 import shlex
+import string
+import logging
+import types
+
+try:
+    import lexer
+    import optimize
+    import stages
+    import tracing
+    import variables
+except ModuleNotFoundError:
+    import monolith.lexer as lexer
+    import monolith.optimize as optimize
+    import monolith.stages as stages
+    import monolith.tracing as tracing
+    import monolith.variables as variables
+
+
+def _default_extractor():
+    # Next to this module, whether it was imported from the package or not
+    if __package__:
+        from . import extract
+    else:
+        import extract
+    return extract.default_extractor
+
+
+def _default_artifact_store():
+    # Next to this module, whether it was imported from the package or not
+    if __package__:
+        from . import store
+    else:
+        import store
+    return store.ArtifactStore()
+
+
+class _Default:
+    """
+    A class attribute that is only made the first time it is used, so
+    parsing alone (`monolith convert`) doesn't import `extract` and `store`
+    """
+    def __init__(self, make):
+        self.make = make
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        # Replace this with the value on the class that has it
+        for cls in owner.__mro__:
+            if cls.__dict__.get(self.name) is self:
+                value = self.make()
+                setattr(cls, self.name, value)
+                return value
+        return self.make()
 
 
 class DockerFileToSingularityFile:
+    # How files for ADD and COPY are gotten out of the image
+    extractor = _Default(_default_extractor)
+    # Where those files are kept between runs, set to `None` to always extract them
+    artifact_store = _Default(_default_artifact_store)
+
     # TODO get the proper runscript
     FILE_TEMPLATE = """
 Bootstrap: {bootstrap}
@@ -62,7 +122,7 @@ From: {image}
 
 
 %runscript
-    # commands to be executed when the container runs
+    # commands to be executed when the container runs{runscript}
     if [ -z "$1" ]
     then
         exec {entrypoint} {cmd}
@@ -77,83 +137,183 @@ From: {image}
     {test}
 
 """
-    # The first character doesn't get a slash, so we add it in the first one
-    PARAM_ALLOWABLE_CHARACTERS_REGEX = '\w\ \t\\' + '\\'.join("!@#$%^&*()-_=+[{]}\|;:'\",<.>/?~`")
-    PARAM_PATTERN = r'(?:[{PARAM_ALLOWABLE_CHARACTERS_REGEX}]+\s*\\\s*)*(?:[{PARAM_ALLOWABLE_CHARACTERS_REGEX}]+)\n'.format(PARAM_ALLOWABLE_CHARACTERS_REGEX=PARAM_ALLOWABLE_CHARACTERS_REGEX)
-    SEARCH_PATTERN = r'^\s*(\w+)\s+({PARAM_PATTERN})'.format(PARAM_PATTERN=PARAM_PATTERN)
+    # `key=value`, where value can have quoted parts and escaped characters
+    VALUE_PATTERN = r"""[^\s"'\\]*(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"|'[^']*'|\\.)[^\s"'\\]*)*"""
+    KEY_VALUE_REGEX = re.compile(r'([^\s=]+)(=?)({value})'.format(value=VALUE_PATTERN))
+    KEY_VALUE_LIST_REGEX = re.compile(r'[^\s=]+(?:={value})?(?:\s+[^\s=]+(?:={value})?)*'.format(value=VALUE_PATTERN))
+    # ARG and ENV values are substituted into these, the rest are left to the shell like docker does.
+    # ARG, ENV and LABEL are split into keys and values first, see `expand_word`,
+    # and ADD and COPY leave their heredocs alone
+    EXPANDED_INSTRUCTIONS = {'EXPOSE', 'FROM', 'ONBUILD', 'STOPSIGNAL', 'USER', 'VOLUME', 'WORKDIR'}
 
-    def __init__(self, docker_image_name, folder='./'):
+    def __init__(self, docker_image_name, folder='./', optimize=False):
+        self._global_args = {}  # ARGs from before FROM
         self.clear_state()
+        self._before_from = True  # Only ARGs after FROM get to RUN
         self.docker_image_name = docker_image_name  # Needed for pulling images from dockerhub
         self.folder = folder
+        # Take redundant apt and pip work out of %post when writing, see `optimize.optimize_post`
+        self.optimize = optimize
+        self.optimization = None  # What the optimizer did
         self.dockerfile_code = []
-        
-        self.ops = {}
-        
-        for name, method in inspect.getmembers(self, predicate=inspect.ismethod):
+
+    @classmethod
+    def get_ops(cls):
+        """
+        The table of instruction name -> handler, built once per class
+        """
+        if '_ops' not in cls.__dict__:
             # Instructions are defined by being all uppercase
-            if name.isupper():
-                self.ops[name] = method
+            cls._ops = {name: getattr(cls, name) for name in dir(cls)
+                        if name.isupper() and isinstance(getattr(cls, name), types.FunctionType)}
+        return cls._ops
+
+    @classmethod
+    def get_base_image(cls, code):
+        """
+        Return the image `code` is built from, only running ARG and FROM
+
+        For a multi-stage dockerfile that is the image the final stage is
+        built on, not the one from the first FROM
+        """
+        m = cls(None)
+        graph = stages.StageGraph(lexer.get_instructions(code))
+        for inst, params, first_line, last_line in graph.preamble:
+            if inst == 'ARG':
+                m.ARG(m.expand(params))
+        chain = graph.chain()
+        if chain:
+            m.FROM(m.expand(chain[0].instructions[0].params))
+        return m.image
 
     def clear_state(self):
         self.bootstrap = ""
         self.image = ""
-        self._setup = ""  # TODO do I need this?
-        self.setup = ""
-        self.files = ""
-        self.labels = ""
-        self.post = ""
+        # The sections are built up as lists of strings and only joined when written
+        self._setup = []  # TODO do I need this?
+        self.setup = []
+        self.files = []
+        self.labels = []
+        self.post = []
         #self.environment = ""
         self._environment = {}
+        self._variables = {}  # ARG and ENV values in scope, see `expand`
+        self._stage_args = []  # ARGs exported in %post for the RUNs of this image
         self.entrypoint = ""
         self.cmd = ""
         self.test = ""
         self.docker_workdir = "/"
+        self.workdir = None  # Where the runscript starts, from WORKDIR
+        self._pending_files = []  # (srcs, dest) of ADD and COPY, see `extract_files`
     
-    def parse(self, code):
+    def parse(self, code, target=None):
+        """
+        Run the instructions in `code` that go into the image
+
+        With a multi-stage dockerfile that is the stages `target` (the last
+        stage by default) is built on, see `stages.StageGraph`. Other stages
+        are skipped before anything is done for them.
+        """
         self.dockerfile_code.append(code)
+        self._before_from = True
+
+        ops = self.get_ops()
+        graph = stages.StageGraph(lexer.get_instructions(code))
+        for inst, params, first_line, last_line in graph.get_instructions(target):
+            logging.debug('inst: `%s`; params: `%s`', inst, params)
+            op = ops.get(inst)
+            if op is None:
+                logging.warning("Skipping unknown instruction `{inst}` on line {line}".format(inst=inst, line=first_line))
+                continue
+            self.post.append('\n    # {inst} {params}'.format(inst=inst, params=params.replace('\\', '').replace('\'', '').replace('"', '')[:min([30, params.find('\n')]) if len(params) > 30 else len(params)].strip() + '...' if len(params) > 30 else ''))
+            if inst in self.EXPANDED_INSTRUCTIONS:
+                params = self.expand(params)
+            with tracing.span(inst, category='parse', line=first_line):
+                op(self, params)
+
+    def expand(self, params):
+        """
+        Substitute the ARG and ENV variables in scope into `params`
+        """
+        return variables.expand(params, self._variables)
+
+    def expand_word(self, word):
+        """
+        Substitute the variables in scope into one value of ARG, ENV or LABEL
+        """
+        return variables.expand_word(word, self._variables)
 
-        # Remove all comment lines
-        code = '\n'.join([line for line in code.split('\n') if not re.match(r'^\s*#', line)])
-        # Need an empty line at the end
-        if not code.endswith('\n'):
-            code += '\n'
 
-        for inst, params in re.findall(self.SEARCH_PATTERN, code, re.MULTILINE):
-            # Remove any extra lines in params
-            # XXX Need to find a better way to do this
-            params = '\n'.join([line for line in params.split('\n') if line.split()]) + '\n'
-            print('inst: `{inst}`; params: `{params}`'.format(inst=inst, params=params.strip()))
-            self.post += '\n    # {inst} {params}'.format(inst=inst, params=params.replace('\\', '').replace('\'', '').replace('"', '')[:min([30, params.find('\n')]) if len(params) > 30 else len(params)].strip() + '...' if len(params) > 30 else '')
-            op = self.ops[inst]
-            op(params)
+    def parse_image_config(self, config):
+        """
+        Fill in the file from the config of an image in a registry (see
+        `registry.Registry.get_config`) instead of from its dockerfiles
 
+        Everything the dockerfiles RUN is already in the image, so only the
+        environment, labels, working directory, entrypoint and cmd are needed
+        """
+        container_config = config.get('config') or {}
+        for env in container_config.get('Env') or []:
+            key, _, value = env.partition('=')
+            export = 'export {key}={value}'.format(key=key, value=shlex.quote(value))
+            self.post.append('\n    echo {export} >> $SINGULARITY_ENVIRONMENT'.format(export=shlex.quote(export)))
+            self.post.append('\n    ' + export)
+        for key, value in sorted((container_config.get('Labels') or {}).items()):
+            self.labels.append('\n    {key} {value}'.format(key=key, value=value))
+        if container_config.get('WorkingDir'):
+            self.workdir = container_config['WorkingDir']
+        self.entrypoint = ' '.join(shlex.quote(word) for word in container_config.get('Entrypoint') or [])
+        self.cmd = ' '.join(shlex.quote(word) for word in container_config.get('Cmd') or [])
+
+    @property
+    def runscript(self):
+        """
+        Run from the WORKDIR, like docker does
+        """
+        if not self.workdir:
+            return ''
+        return '\n    cd {workdir}'.format(workdir=shlex.quote(self.workdir))
 
     def singularity_file(self):
         """
         Return the formated Singularity file
         """
-        return self.FILE_TEMPLATE.format(bootstrap=self.bootstrap,
-                                         image=self.image,
-                                         setup=self.setup,
-                                         files=self.files,
-                                         labels=self.labels,
-                                         post=self.post,
-                                         environment=self.environment,
-                                         entrypoint=self.entrypoint,
-                                         cmd=self.cmd,
-                                         test=self.test)
-
-    def write_singularity_file(self, filename='Singularity'):
-        with open(os.path.join(self.folder, filename), 'w') as f:
-            f.write(self.singularity_file())
-    
+        f = io.StringIO()
+        self.write_singularity_file(f)
+        return f.getvalue()
+
+    def write_singularity_file(self, fp='Singularity'):
+        """
+        Write the Singularity file out one section at a time
+        `fp` is either a file object or the name of a file in `folder`
+        """
+        if not hasattr(fp, 'write'):
+            with open(os.path.join(self.folder, fp), 'w') as f:
+                return self.write_singularity_file(f)
+        self.extract_files()
+        if self.optimize and self.optimization is None:
+            self.post, self.optimization = optimize.optimize_post(self.post)
+        for literal, field, _, _ in string.Formatter().parse(self.FILE_TEMPLATE):
+            fp.write(literal)
+            if field is not None:
+                value = getattr(self, field)
+                if isinstance(value, list):
+                    fp.writelines(value)
+                else:
+                    fp.write(value)
+
     def dockerfile(self):
         return ''.join(self.dockerfile_code)
-    
-    def write_dockerfile(self, filename='Dockerfile'):
-        with open(os.path.join(self.folder, filename), 'w') as f:
-            f.write(self.dockerfile())
+
+    def write_dockerfile(self, fp='Dockerfile'):
+        """
+        `fp` is either a file object or the name of a file in `folder`
+        """
+        if not hasattr(fp, 'write'):
+            with open(os.path.join(self.folder, fp), 'w') as f:
+                return self.write_dockerfile(f)
+        fp.writelines(self.dockerfile_code)
+
     @property
     def setup(self):
         """
@@ -186,22 +346,24 @@ From: {image}
         return ' '.join(s)
     
     def get_key_value_pairs(self, params):
+        """
+        KEY value
+        KEY1=value1 KEY2="value 2" ...
+
+        Values keep their quotes, a key without a value has the value None
+        """
         # Linearize it
-        params = ' '.join((line.replace('\\', '').strip() for line in params.splitlines()))
-        no_double_quotes = self.PARAM_ALLOWABLE_CHARACTERS_REGEX.replace('\"', '')
-        regex = r'([\w\.\d]+)[=\s+]((?:[{no_double_quotes}]+)|(?:\"[{no_double_quotes}]+\"))'.format(no_double_quotes=no_double_quotes)
-        regex = self.SEARCH_PATTERN.replace('\"', '')
-        regex = r'([\w\.\d]+)[=\s+]?((?:[{no_double_quotes}]+)|(?:\"[{no_double_quotes}]+\"))?'.format(no_double_quotes=no_double_quotes)
-        pairs = []
-        while params:
-            # Get one match, then do it again on the rest of the string
-            m = re.match(regex, params)
-            if not m:
-                raise Exception("Malformed params: {params}".format(params=params.encode()))
-            key, value = m.groups()
-            pairs.append((key, value))
-            params = params[m.span()[1]:].strip()
-        return pairs
+        params = ' '.join(line.rstrip('\\').strip() for line in params.splitlines()).strip()
+        if not params:
+            return []
+        key, _, value = params.partition(' ')
+        if '=' not in key:
+            # The old `KEY value` form, everything after the key is the value
+            return [(key, value.strip() or None)]
+        if not self.KEY_VALUE_LIST_REGEX.fullmatch(params):
+            raise Exception("Malformed params: {params}".format(params=params.encode()))
+        return [(key, value if has_value else None)
+                for key, has_value, value in self.KEY_VALUE_REGEX.findall(params)]
         
     def ARG(self, params):
         """
@@ -212,33 +374,53 @@ From: {image}
         ARG <name>[=<default value>]
         """
         for key, value in self.get_key_value_pairs(params):
+            if value is None:
+                # `ARG <name>` after FROM gets the value of an ARG before it
+                value = self._global_args.get(key)
+                if value is None:
+                    continue
+                value = variables.quote(value)
+            else:
+                value = self.expand_word(value)
             self._environment[key] = value
+            self._variables[key] = variables.literal(value)
+            if not self._before_from:
+                # RUN sees it as an environment variable
+                self.post.append('\n    export {key}={value}'.format(key=key, value=value))
+                if key not in self._stage_args:
+                    self._stage_args.append(key)
 
     def FROM(self, params):
         """
-        FROM <image> [AS <name>]
-        FROM <image>[:<tag>] [AS <name>]
-        FROM <image>[@<digest>] [AS <name>]
+        FROM [--platform=<platform>] <image> [AS <name>]
+        FROM [--platform=<platform>] <image>[:<tag>] [AS <name>]
+        FROM [--platform=<platform>] <image>[@<digest>] [AS <name>]
+
+        Only the FROM of the first stage `parse` runs gets here, the stages
+        after it are built on the one before
         """
-        # First we need to substitute variables in environment with the params
+        self._before_from = False
         if self.image:
-            self.post += '    # skipped, already have image'.format(params=params)
+            self.post.append('    # skipped, already have image'.format(params=params))
+            if self._stage_args:
+                # ARGs only last for the image they are in
+                self.post.append('\n    unset {keys}'.format(keys=' '.join(self._stage_args)))
+                for key in self._stage_args:
+                    self._variables.pop(key, None)
+                self._stage_args = []
             return
-        for key in self._environment:
-            # ${variable} format
-            search_list = ['${key}'.format(key=key), '${{{key}}}'.format(key=key)]
-            for s in search_list:
-                if s in params:
-                    # Do replacement
-                    params = params.replace(s, self._environment[key])
-                    continue
-            
 
-        # Encountering a new FROM clears all state
+        # Encountering a new FROM clears all state, but ARGs from before it
+        # can still be brought in with `ARG <name>`
+        global_args = self._variables
         self.clear_state()
-        self.post += '\n    # FROM {params}'.format(params=params.strip())
+        self._global_args = global_args
+        self.post.append('\n    # FROM {params}'.format(params=params.strip()))
 
-        print('---FROM: ' + params)
+        logging.debug('---FROM: %s', params)
+        m = stages.FROM_REGEX.match(params.strip())
+        if m:
+            params = m.group(1)
         # Get everything in the form given in the docstring. Include characters, digits, and '-'
         regex = r"^(?:([\w\-\d\.]+)\/)?([\w\-\d\.]+)(?::([@:\w\-\d\.]+))?$"
 
@@ -249,7 +431,7 @@ From: {image}
         user, image, tag = m.groups()
         user = user + '/' if user else ''
         tag = tag if tag else 'latest'
-        print(user, image, tag)
+        logging.debug('%s %s %s', user, image, tag)
         
         self.bootstrap = 'docker'
         self.image = '{user}{image}:{tag}'.format(user=user, image=image, tag=tag)
@@ -265,9 +447,9 @@ From: {image}
                 s = self.get_list_string(params)
             except:
                 raise Exception("Malformed params for RUN: {params}".format(params=params))
-            self.post += '\n    ' + ' '.join(s)
+            self.post.append('\n    ' + ' '.join(s))
         else:
-            self.post += '\n    ' + params
+            self.post.append(optimize.RunCommand(params))
     
     def CMD(self, params):
         """
@@ -291,7 +473,9 @@ From: {image}
         """
         pairs = self.get_key_value_pairs(params.strip())
         for key, value in pairs:
-            self.labels += '\n    {key} {value}'.format(key=key, value=value)
+            if value is not None:
+                value = self.expand_word(value)
+            self.labels.append('\n    {key} {value}'.format(key=key, value=value))
     
     def MAINTAINER(self, params):
         """
@@ -313,82 +497,142 @@ From: {image}
         ENV <key>=<value> ...
         """
         for key,value in self.get_key_value_pairs(params):
-            # If we have some args then replace them when nessesary
-            if value.startswith('$'):
-                _tmpvalue = value.replace('$', '')
-                if _tmpvalue in self._environment:
-                    value = self._environment[_tmpvalue]
-            self.post += '\n    echo \'export {key}={value}\' >> $SINGULARITY_ENVIRONMENT'.format(key=key, value=value)
-            self.post += '\n    export {key}={value}'.format(key=key, value=value)
+            value = self.expand_word(value) if value is not None else ''
+            self._variables[key] = variables.literal(value)
+            if key in self._stage_args:
+                # Not just an ARG anymore, it lasts
+                self._stage_args.remove(key)
+            self.post.append('\n    echo \'export {key}={value}\' >> $SINGULARITY_ENVIRONMENT'.format(key=key, value=value))
+            self.post.append('\n    export {key}={value}'.format(key=key, value=value))
 
     def ADD(self, params):
         """
         ADD [--chown=<user>:<group>] <src>... <dest>
         ADD [--chown=<user>:<group>] ["<src>",... "<dest>"]
+        COPY --from=<stage> <src>... <dest>
         
         ADD hom* /mydir/        # adds all files starting with "hom"
         ADD hom?.txt /mydir/    # ? is replaced with any single character, e.g., "home.txt"
         ADD test relativeDir/          # adds "test" to `WORKDIR`/relativeDir/
         ADD test /absoluteDir/         # adds "test" to /absoluteDir/
         
-        We assume the dest is a file (1:1 relation of src and dest)
-        TODO sometimes dest is just a dir
-        """
-        print(' ADD params `{params}`'.format(params=params.strip()))
+        If dest is a file in the image we use that (1:1 relation of src and
+        dest), otherwise dest is a dir and we use dest/<src> for each src
+        """
+        logging.debug(' ADD params `%s`', params)
+        params, heredocs = self.split_heredocs(params)
+        params = self.expand(params)
+        # The files are gotten out of the image, so where they came from doesn't matter
+        params = re.sub(r'^(?:--\S+\s+)*', '', params.strip())
         regex = r'([\S]+)'  # TODO doesnt allow " or space
-        srcs = set()
+        srcs = []
         dest = None
         while params:
-            #print(' ADD params `{params}`'.format(params=params))
             # Get one match, then do it again on the rest of the string
             m = re.match(regex, params)
             if not m:
                 raise Exception("Malformed params for ADD: {params}".format(params=params))
-            # TODO work in workdir if its not an absolute path
             src, = m.groups()
             
             # Add the current dest as a source, then make the last entry the dest
             if dest:
-                srcs.add(dest)
+                srcs.append(dest)
             dest = src
-            print("srcs: `{srcs}`; dest: `{dest}`".format(srcs=srcs, dest=dest))
+            logging.debug("srcs: `%s`; dest: `%s`", srcs, dest)
 
             params = params[m.span()[1]:].strip()
-            
-        print("Downloading `{dest}` from `{docker_image_name}`".format(dest=dest, docker_image_name=shlex.quote(self.docker_image_name)))
-        # Make sure the image is pulled
-        subprocess.run("docker pull {docker_image_name}".format(docker_image_name=shlex.quote(self.docker_image_name)).split())
-        
-        # TODO do we care to preserve the folder structure of /src? We might if people have the same filename if different folders, but lets skip that for now
-        # TODO need to work in workdir, get that working. We currently assume that dest starts with a /
-        cmd = "docker run --rm --entrypoint cat {docker_image_name} {dest}"
-        
-        try:
-            # First try to just get the destination. If might be a file and this will just work
-            names = [dest]
-            print("Downloading: {names}".format(names=names))
-            files = [(s, subprocess.run(cmd.format(dest=s, docker_image_name=shlex.quote(self.docker_image_name)).split(), stdout=subprocess.PIPE)) for s in names]
-            # On linux this raised an error, on windows it didnt, so lets check to be sure
-            for path, process in files:
-                process.check_returncode()
-            self.setup += '\n    mkdir -p $SINGULARITY_ROOTFS/{dest}'.format(dest=os.path.dirname(dest))
-        except (FileNotFoundError, subprocess.CalledProcessError):
-            # Its a folder, we need to empty the contents
-            # TODO figure out how to get multiple out of wildcards and whatnot
-            names = [os.path.join(dest,s) for s in srcs]
-            print("Scratch that, downloading: {names}".format(names=names))
-            files = [(s, subprocess.run(cmd.format(dest=s, docker_image_name=shlex.quote(self.docker_image_name)).split(), stdout=subprocess.PIPE)) for s in names]
-            self.setup += '\n    mkdir -p $SINGULARITY_ROOTFS/{dest}'.format(dest=dest)
-            
-        for path, process in files:
-            process.check_returncode()
-            basename = os.path.basename(path)
-            print("Path: `{path}`; basename: {basename}".format(path=path, basename=basename))
-            with open(os.path.join(shlex.quote(self.folder), basename), 'wb') as f:
-                f.write(process.stdout)
-
-            self.files += "\n    {basename} {dest}".format(basename=basename, dest=dest)
-        
+
+        if dest is None:
+            raise Exception("Malformed params for ADD, there is no destination")
+        # Relative to the WORKDIR, and never above the root of the image
+        folder = dest.endswith('/')
+        dest = '/' + os.path.normpath(os.path.join('/', self.workdir or '/', dest)).lstrip('/')
+        if folder and dest != '/':
+            dest += '/'
+
+        # The heredocs are written by %post, the files they stand in for aren't anywhere
+        srcs = [src for src in srcs if not lexer.HEREDOC_REGEX.fullmatch(src)]
+        for (strip_tabs, quote, name), body in heredocs:
+            filename = os.path.join(dest, name) if folder or srcs or len(heredocs) > 1 else dest
+            self.post.append('\n    mkdir -p {folder}\n    cat > {filename} <<{delimiter}\n{body}{name}'.format(
+                folder=shlex.quote(os.path.dirname(filename)), filename=shlex.quote(filename),
+                delimiter="'{name}'".format(name=name) if quote else name, body=''.join(line + '\n' for line in body), name=name))
+        if not srcs:
+            return
+
+        # Getting files out of the image is slow, so it is done for every
+        # ADD and COPY at once in `extract_files`
+        self._pending_files.append((srcs, dest))
+
+    @staticmethod
+    def split_heredocs(params):
+        """
+        Split the params of an ADD or COPY into the instruction and a list of
+        each heredoc in it, `((strip_tabs, quote, name), body lines)`
+        """
+        lines = params.split('\n')
+        heredocs = []
+        quote = None
+        number = 0
+        # The instruction is up to the first line that isn't continued
+        while number < len(lines):
+            found, quote = lexer.find_heredocs(lines[number], '\\', quote)
+            heredocs.extend(found)
+            number += 1
+            if not lines[number - 1].rstrip().endswith('\\'):
+                break
+        instruction = '\n'.join(lines[:number])
+        bodies = []
+        for strip_tabs, quote, name in heredocs:
+            body = []
+            while number < len(lines):
+                line = lines[number].lstrip('\t') if strip_tabs else lines[number]
+                number += 1
+                if line == name:
+                    break
+                body.append(line)
+            bodies.append(((strip_tabs, quote, name), body))
+        return instruction, bodies
+
+    def extract_files(self):
+        """
+        Get the files for every ADD and COPY so far out of the image, all at once
+        """
+        pending, self._pending_files = self._pending_files, []
+        if not pending:
+            return
+        # We don't know if dest is a file or a folder yet, so ask for both
+        paths = []
+        for srcs, dest in pending:
+            for path in [dest, *(os.path.join(dest, os.path.basename(s)) for s in srcs)]:
+                if path not in paths:
+                    paths.append(path)
+        logging.info("Downloading: %s from `%s`", paths, self.docker_image_name)
+        # The files are put under `files/` with the same path they have in the image
+        files_folder = os.path.join(self.folder, 'files')
+        if self.artifact_store is not None:
+            local = self.artifact_store.get_files(self.extractor, self.docker_image_name, paths, files_folder)
+        else:
+            local = {path: extracted.filename if extracted else None
+                     for path, extracted in self.extractor.extract(self.docker_image_name, paths, files_folder).items()}
+
+        for srcs, dest in pending:
+            if local[dest]:
+                names = [dest]
+                self.setup.append('\n    mkdir -p $SINGULARITY_ROOTFS/{dest}'.format(dest=os.path.dirname(dest)))
+            else:
+                # Its a folder, we need the contents
+                # TODO figure out how to get multiple out of wildcards and whatnot
+                names = [os.path.join(dest, os.path.basename(s)) for s in srcs]
+                self.setup.append('\n    mkdir -p $SINGULARITY_ROOTFS/{dest}'.format(dest=dest))
+
+            for path in names:
+                if local[path] is None:
+                    raise FileNotFoundError("Could not find `{path}` in `{docker_image_name}`".format(path=path, docker_image_name=self.docker_image_name))
+                filename = os.path.relpath(local[path], self.folder)
+                logging.debug("Path: `%s`; filename: %s", path, filename)
+                self.files.append("\n    {filename} {path}".format(filename=filename, path=path))
+
     def COPY(self, params):
         return self.ADD(params)
     
@@ -428,7 +672,8 @@ From: {image}
         """
         WORKDIR /path/to/workdir
         """
-        self.workdir = params
+        # A relative path is relative to the last one
+        self.workdir = os.path.join(self.workdir or '/', params.strip())
     
     def ONBUILD(self, params):
         """
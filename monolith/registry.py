@@ -0,0 +1,207 @@
+"""
+A small client for the docker registry v2 api
+https://docs.docker.com/registry/spec/api/
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+
+try:
+    import image_types
+    import transport
+except ModuleNotFoundError:
+    import monolith.image_types as image_types
+    import monolith.transport as transport
+
+DOCKER_REGISTRY_URL = 'https://registry.hub.docker.com/v2/'
+
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST_V2 = 'application/vnd.docker.distribution.manifest.list.v2+json'
+OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+MANIFEST_LISTS = (MANIFEST_LIST_V2, OCI_INDEX)
+
+_NOT_LOOKED_UP = object()
+
+
+class Registry:
+    """
+    Everything that can be reused between requests is cached: where to get
+    tokens from is looked up once, tokens are kept until they expire and
+    manifests are kept by digest. Tags are remembered for `tag_ttl` seconds.
+    It is safe to use from multiple threads.
+    """
+    # How long before a token expires that we stop using it
+    TOKEN_SLACK = 10
+
+    def __init__(self, url=DOCKER_REGISTRY_URL, http=None, platform=('linux', 'amd64'), tag_ttl=300):
+        self.url = url
+        self.http = http or transport.default_transport
+        self.platform = platform
+        self.tag_ttl = tag_ttl
+        self._realm = _NOT_LOOKED_UP
+        self._tokens = {}  # repository -> (token, when it expires)
+        self._manifests = {}  # (repository, digest, accept) -> (digest, manifest, content type)
+        self._tags = {}  # (repository, tag, accept) -> (digest, when to look again)
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+
+    @staticmethod
+    def get_repository(name):
+        """
+        Return the repository and reference of an image name, official
+        images live under `library/` in the registry
+        """
+        info = image_types.DockerImage.get_docker_info(name)
+        user = 'library' if info.user == '_' else info.user
+        return '{user}/{image}'.format(user=user, image=info.image), info.tag
+
+    @staticmethod
+    def is_digest(reference):
+        return ':' in reference
+
+    def get_realm(self):
+        """
+        Find out where to get tokens from, returns `(realm, service)` or None
+        if the registry doesn't need auth
+        """
+        if self._realm is _NOT_LOOKED_UP:
+            resp = self.http.get(self.url)
+            if resp.status_code != 401:
+                self._realm = None
+            else:
+                m = re.search(r'realm="([^"]*)",service="([^"]*)"', resp.headers['Www-Authenticate'])
+                self._realm = m.groups()
+        return self._realm
+
+    def prefetch_tokens(self, repositories):
+        """
+        Get a single token that can pull from all of `repositories`
+        """
+        with self._token_lock:
+            now = time.monotonic()
+            needed = sorted({repository for repository in repositories
+                             if self._tokens.get(repository, (None, 0))[1] <= now})
+            if not needed:
+                return
+            realm = self.get_realm()
+            if realm is None:
+                return
+            # https://docs.docker.com/registry/spec/auth/token/#how-to-authenticate
+            auth_url, service = realm
+            scopes = ['repository:{repository}:pull'.format(repository=repository) for repository in needed]
+            resp = self.http.get(auth_url, params={'service': service, 'scope': scopes})
+            resp.raise_for_status()
+            body = resp.json()
+            token = body.get('token') or body.get('access_token')
+            # The spec says to assume 60 seconds if we aren't told
+            expires = time.monotonic() + body.get('expires_in', 60) - self.TOKEN_SLACK
+            for repository in needed:
+                self._tokens[repository] = (token, expires)
+
+    def get_token(self, repository):
+        """
+        Get a token to pull from `repository`
+        """
+        token, expires = self._tokens.get(repository, (None, 0))
+        if expires <= time.monotonic():
+            self.prefetch_tokens([repository])
+            token, expires = self._tokens.get(repository, (None, 0))
+        return token
+
+    def get_headers(self, repository, accept=None):
+        headers = {}
+        token = self.get_token(repository)
+        if token:
+            headers['Authorization'] = 'Bearer {token}'.format(token=token)
+        if accept:
+            headers['Accept'] = accept
+        return headers
+
+    def _manifest_url(self, repository, reference):
+        return '{url}{repository}/manifests/{reference}'.format(url=self.url, repository=repository, reference=reference)
+
+    def get_raw_manifest(self, repository, reference, accept):
+        """
+        Return `(digest, manifest, content type)` for a reference (tag or digest)
+        """
+        with self._lock:
+            if not self.is_digest(reference):
+                digest, expires = self._tags.get((repository, reference, accept), (None, 0))
+                if expires > time.monotonic():
+                    reference = digest
+            cached = self._manifests.get((repository, reference, accept))
+        if cached is not None:
+            return cached
+
+        url = self._manifest_url(repository, reference)
+        logging.debug("Looking up: " + url)
+        resp = self.http.get(url, headers=self.get_headers(repository, accept=accept))
+        resp.raise_for_status()
+        digest = resp.headers.get('Docker-Content-Digest')
+        if digest is None:
+            # The digest of a manifest is the sha256 of it as it was sent
+            digest = reference if self.is_digest(reference) else 'sha256:' + hashlib.sha256(resp.content).hexdigest()
+        result = (digest, resp.json(), resp.headers.get('Content-Type'))
+        if digest:
+            with self._lock:
+                self._manifests[(repository, digest, accept)] = result
+                if not self.is_digest(reference):
+                    self._tags[(repository, reference, accept)] = (digest, time.monotonic() + self.tag_ttl)
+        return result
+
+    def get_digest(self, repository, reference, accept=MANIFEST_V2):
+        """
+        Get the digest of a manifest without downloading it
+        """
+        if self.is_digest(reference):
+            return reference
+        resp = self.http.head(self._manifest_url(repository, reference), headers=self.get_headers(repository, accept=accept))
+        resp.raise_for_status()
+        return resp.headers['Docker-Content-Digest']
+
+    def get_manifest(self, name):
+        """
+        Return `(repository, digest, manifest)` for the image `name`
+
+        Manifest lists are followed to the manifest for `platform`
+        """
+        repository, reference = self.get_repository(name)
+        accept = ', '.join((MANIFEST_V2, OCI_MANIFEST, *MANIFEST_LISTS))
+        digest, manifest, content_type = self.get_raw_manifest(repository, reference, accept)
+
+        if manifest.get('mediaType', content_type) in MANIFEST_LISTS:
+            os_, architecture = self.platform
+            for entry in manifest['manifests']:
+                platform = entry.get('platform', {})
+                if platform.get('os') == os_ and platform.get('architecture') == architecture:
+                    break
+            else:
+                raise Exception("No manifest for {os}/{architecture} in `{name}`".format(os=os_, architecture=architecture, name=name))
+            digest, manifest, content_type = self.get_raw_manifest(repository, entry['digest'], accept)
+
+        return repository, digest, manifest
+
+    def get_config(self, name):
+        """
+        Return `(repository, digest, config)` for the image `name`, where
+        `config` is the decoded image config (Env, Entrypoint, Cmd, Labels...)
+
+        That is the manifest and the config blob, plus a token and the
+        platform's manifest when needed, no matter how many layers there are
+        """
+        repository, digest, manifest = self.get_manifest(name)
+        config = self.get_blob(repository, manifest['config']['digest']).json()
+        return repository, digest, config
+
+    def get_blob(self, repository, digest, stream=False):
+        """
+        Get a blob (a layer or a config) from `repository`
+        With `stream` the body is left unread, use `response.raw`
+        """
+        url = '{url}{repository}/blobs/{digest}'.format(url=self.url, repository=repository, digest=digest)
+        resp = self.http.get(url, headers=self.get_headers(repository), stream=stream)
+        resp.raise_for_status()
+        return resp
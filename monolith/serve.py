@@ -0,0 +1,405 @@
+"""
+Keep monolith running and convert images as they are asked for
+
+    monolith serve --port 8734
+    monolith serve --socket /tmp/monolith.sock
+
+    curl localhost:8734/monolith/kaixhin/cuda-caffe
+    curl 'localhost:8734/singularity/kaixhin/cuda-caffe?optimize=1'
+    curl --data-binary @Dockerfile localhost:8734/convert
+    curl --unix-socket /tmp/monolith.sock http://localhost/stats
+
+Everything a single run throws away stays warm between requests: the
+lineages of the images asked for, what was generated from them, the parsed
+dockerfiles, the dockerhub connections and the registry tokens. Requests for
+the same thing that arrive while it is being made wait for that one instead
+of making it again.
+"""
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import re
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+try:
+    import convert
+    import extract
+    import image_types
+    import lexer
+    import manifest
+    import parsers
+    import tracing
+except ModuleNotFoundError:
+    import monolith.convert as convert
+    import monolith.extract as extract
+    import monolith.image_types as image_types
+    import monolith.lexer as lexer
+    import monolith.manifest as manifest
+    import monolith.parsers as parsers
+    import monolith.tracing as tracing
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8734
+# How long a lineage is used before it is gotten again, the dockerfile cache
+# still saves the downloads if nothing changed
+DEFAULT_LINEAGE_TTL = 5 * 60
+# How many generated files are kept in memory
+DEFAULT_RESULT_CACHE_SIZE = 1024
+# How many latencies per endpoint the percentiles are worked out from
+LATENCY_SAMPLES = 1024
+
+
+class Coalescer:
+    """
+    Runs `fn` once for every caller asking for the same `key` at the same time
+    """
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, *args):
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if owner:
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+        return future.result()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+
+class ResultCache:
+    """
+    A thread safe LRU of generated files, keyed by what they were generated from
+    """
+    def __init__(self, max_size=DEFAULT_RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+class Latencies:
+    """
+    How long each endpoint takes, with percentiles over the latest requests
+    """
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=samples))
+        self._counts = collections.Counter()
+        self._errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, error=False):
+        with self._lock:
+            self._samples[endpoint].append(seconds)
+            self._counts[endpoint] += 1
+            if error:
+                self._errors[endpoint] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for endpoint, samples in self._samples.items():
+                ordered = sorted(samples)
+                stats[endpoint] = {'requests': self._counts[endpoint],
+                                   'errors': self._errors[endpoint],
+                                   'p50_ms': 1000 * ordered[len(ordered) // 2],
+                                   'p95_ms': 1000 * ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+                                   'max_ms': 1000 * ordered[-1]}
+            return stats
+
+
+class NotFound(Exception):
+    pass
+
+
+class ConversionService:
+    """
+    Everything the server keeps between requests
+
+    A `DockerFileToSingularityFile` holds the state of one conversion, so a
+    new one is made for every file generated and they are never shared
+    between threads. Everything that is shared (the dockerfile cache, lineage
+    index, transport, lexer cache and artifact store) has its own lock.
+    """
+    def __init__(self, output_dir='.', lineage_ttl=DEFAULT_LINEAGE_TTL, result_cache_size=DEFAULT_RESULT_CACHE_SIZE):
+        self.output_dir = output_dir
+        self.lineage_ttl = lineage_ttl
+        self.started = time.time()
+        self.coalescer = Coalescer()
+        self.results = ResultCache(result_cache_size)
+        self.latencies = Latencies()
+        self._images = {}  # Name -> (time it was gotten, node)
+        self._images_lock = threading.Lock()
+        self._folder_locks = collections.defaultdict(threading.Lock)
+
+    def get_image(self, name):
+        """
+        The node for `name`, gotten again once it is older than `lineage_ttl`
+        """
+        with self._images_lock:
+            fetched, image = self._images.get(name, (0, None))
+        if image is not None and time.time() - fetched < self.lineage_ttl:
+            return image
+        return self.coalescer.run(('image', name), self._fetch_image, name)
+
+    def _fetch_image(self, name):
+        image = image_types.DockerImage.get_forest([name])[name]
+        if not image.dockerfile:
+            raise NotFound("Could not find a dockerfile for `{name}`".format(name=name))
+        with self._images_lock:
+            self._images[name] = (time.time(), image)
+        return image
+
+    def get_folder(self, name):
+        return os.path.join(self.output_dir, re.sub(r'[^\w.\-]', '_', name))
+
+    def monolith(self, name):
+        image = self.get_image(name)
+        return ''.join(image.get_monolith())
+
+    def singularity(self, name, options):
+        """
+        The Singularity file for `name`, ADD and COPY are put in its folder
+        under `output_dir`
+        """
+        image = self.get_image(name)
+        lineage = image.get_lineage()
+        key = ('singularity', name, manifest.lineage_hash(lineage, options))
+        text = self.results.get(key)
+        if text is None:
+            text = self.coalescer.run(key, self._singularity, name, lineage, options)
+            self.results.put(key, text)
+        return text
+
+    def _singularity(self, name, lineage, options):
+        folder = self.get_folder(name)
+        os.makedirs(folder, exist_ok=True)
+        parser = parsers.DockerFileToSingularityFile(name, folder=folder, optimize=options['optimize'])
+        with tracing.span('parse', image=name):
+            for ancestor in lineage:
+                parser.parse(ancestor.dockerfile, target=options['target'] if ancestor is lineage[-1] else None)
+        parser.bootstrap = options['singularity_bootstrap']
+        parser.image = options['singularity_from'] or lineage[0].name
+        # Files for the same image go to the same folder
+        with self._folder_locks[folder]:
+            return parser.singularity_file()
+
+    def convert(self, code, options):
+        """
+        A local dockerfile, see `convert.convert`
+        """
+        key = ('convert', lexer.content_hash(code), manifest.lineage_hash([], options))
+        text = self.results.get(key)
+        if text is None:
+            text = self.coalescer.run(key, convert.convert, code, 'Dockerfile', '.', options['singularity_bootstrap'],
+                                      options['singularity_from'], options['target'], options['optimize'])
+            self.results.put(key, text)
+        return text
+
+    def stats(self):
+        dockerfile_cache = image_types.DockerImage.dockerfile_cache
+        lineage_index = image_types.DockerImage.lineage_index
+        artifact_store = parsers.DockerFileToSingularityFile.artifact_store
+        with self._images_lock:
+            images = len(self._images)
+        return {'uptime': time.time() - self.started,
+                'endpoints': self.latencies.stats(),
+                'in_flight': self.coalescer.in_flight(),
+                'coalesced': self.coalescer.coalesced,
+                'images': images,
+                'results': self.results.stats(),
+                'instruction_cache': len(lexer._instruction_cache),
+                'dockerfile_cache': dockerfile_cache.stats() if dockerfile_cache is not None else None,
+                'lineage_index': len(lineage_index) if lineage_index is not None else None,
+                'artifact_store': artifact_store.stats() if artifact_store is not None else None,
+                'http': image_types.DockerImage.http.metrics()}
+
+
+def get_options(query):
+    """
+    The conversion options from the query string of a request
+    """
+    def get(name, default=None):
+        return query.get(name, [default])[-1]
+    return {'singularity_bootstrap': get('bootstrap', 'docker'),
+            'singularity_from': get('from'),
+            'target': get('target'),
+            'optimize': get('optimize', '0').lower() in ('1', 'true', 'yes')}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET  /monolith/<image>      the monolithic dockerfile
+    GET  /singularity/<image>   the Singularity file
+    POST /convert               the Singularity file for the dockerfile in the body
+    GET  /stats                 cache and latency statistics
+
+    /singularity and /convert take `target`, `optimize`, `bootstrap` and
+    `from` in the query string.
+    """
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately, don't wait between them
+    disable_nagle_algorithm = True
+    server_version = 'monolith'
+    # Set on the subclass made by `make_server`
+    service = None
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        endpoint, _, name = url.path.lstrip('/').partition('/')
+        name = urllib.parse.unquote(name)
+        # Always read the body so the connection can be used again
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        start = time.perf_counter()
+        status = 200
+        try:
+            with tracing.span(endpoint, category='serve', image=name):
+                if endpoint == 'monolith' and name and self.command == 'GET':
+                    self.send_text(status, self.service.monolith(name))
+                elif endpoint == 'singularity' and name and self.command == 'GET':
+                    self.send_text(status, self.service.singularity(name, get_options(query)))
+                elif endpoint == 'convert' and self.command == 'POST':
+                    self.send_text(status, self.service.convert(body.decode(), get_options(query)))
+                elif endpoint == 'stats' and self.command == 'GET':
+                    self.send_text(status, json.dumps(self.service.stats(), indent=2) + '\n', 'application/json')
+                else:
+                    endpoint = 'unknown'
+                    status = 404
+                    self.send_text(status, RequestHandler.__doc__)
+        except NotFound as e:
+            status = 404
+            self.send_text(status, '{error}\n'.format(error=e))
+        except ValueError as e:
+            status = 400
+            self.send_text(status, '{error}\n'.format(error=e))
+        except Exception as e:
+            logging.exception("Failed to handle %s", self.path)
+            status = 500
+            self.send_text(status, '{name}: {error}\n'.format(name=type(e).__name__, error=e))
+        self.service.latencies.add(endpoint, time.perf_counter() - start, error=status >= 500)
+
+    def send_text(self, status, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # `client_address` is empty on a unix socket
+        logging.debug("%s", format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Left behind by a server that was not shut down cleanly
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    """
+    A server for `service` on `socket_path` if it is given, otherwise on `host`:`port`
+    """
+    if socket_path:
+        # There is no Nagle on a unix socket
+        handler = type('RequestHandler', (RequestHandler,), {'service': service, 'disable_nagle_algorithm': False})
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    handler = type('RequestHandler', (RequestHandler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='monolith serve', description="Convert images over HTTP, keeping everything warm between requests")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="The address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="The port to listen on")
+    parser.add_argument('--socket', metavar='PATH', help="Listen on this unix socket instead")
+    parser.add_argument('--output-dir', default='.', help="Where the files for ADD and COPY go, each image gets a folder in here")
+    parser.add_argument('--lineage-ttl', type=int, default=DEFAULT_LINEAGE_TTL, help="Seconds before the lineage of an image is gotten again")
+    parser.add_argument('--extractor', choices=['docker', 'registry'], default='docker', help="Get files for ADD and COPY with the local docker daemon or straight from the registry")
+    parser.add_argument('--body-dir', help="Keep the text of the dockerfiles in this folder instead of all in memory")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log everything that is going on")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.body_dir:
+        image_types.DockerImage.dockerfile_bodies = image_types.DockerfileBodies(args.body_dir)
+    if args.extractor == 'registry':
+        parsers.DockerFileToSingularityFile.extractor = extract.RegistryExtractor()
+    service = ConversionService(args.output_dir, lineage_ttl=args.lineage_ttl)
+    server = make_server(service, args.host, args.port, args.socket)
+    logging.info("Listening on %s", args.socket or 'http://{host}:{port}'.format(host=args.host, port=server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if image_types.DockerImage.dockerfile_cache is not None:
+            image_types.DockerImage.dockerfile_cache.flush()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+The stages of a multi-stage dockerfile and which of them the image needs
+
+    FROM golang AS builder
+    RUN go build -o /app
+    FROM alpine AS unused
+    RUN ...
+    FROM alpine
+    COPY --from=builder /app /app
+
+Each FROM starts a stage. A stage depends on the stage it is built FROM (if
+it is not an image) and on every stage it does `COPY --from=` out of. Only the
+stages the target stage (the last one unless told otherwise) can reach matter.
+"""
+import logging
+import re
+
+# FROM [--platform=<platform>] <image> [AS <name>]
+FROM_REGEX = re.compile(r'^(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?\s*$', re.IGNORECASE)
+COPY_FROM_REGEX = re.compile(r'(?:^|\s)--from=(\S+)')
+
+
+class Stage:
+    __slots__ = ('index', 'name', 'base', 'parent', 'copies_from', 'instructions')
+
+    def __init__(self, index, name, base, parent):
+        self.index = index
+        self.name = name  # From `AS <name>`, can be None
+        self.base = base  # What comes after FROM
+        self.parent = parent  # The stage `base` refers to, None if it is an image
+        self.copies_from = []  # Stages used by `COPY --from=`
+        self.instructions = []  # Starting with the FROM
+
+    def __repr__(self):
+        return "<Stage {index}{name}>".format(index=self.index, name=' ' + self.name if self.name else '')
+
+
+class StageGraph:
+    """
+    Made from the `lexer.Instruction`s of a dockerfile. Instructions before
+    the first FROM (global ARGs) are in `preamble`.
+    """
+    def __init__(self, instructions):
+        self.preamble = []
+        self.stages = []
+        self._names = {}
+        for instruction in instructions:
+            inst, params = instruction.instruction, instruction.params
+            if inst == 'FROM':
+                m = FROM_REGEX.match(params.strip())
+                base, name = m.groups() if m else (params.strip(), None)
+                stage = Stage(len(self.stages), name, base, self.get(base))
+                stage.instructions.append(instruction)
+                self.stages.append(stage)
+                if name:
+                    self._names[name.lower()] = stage
+            elif not self.stages:
+                self.preamble.append(instruction)
+            else:
+                stage = self.stages[-1]
+                stage.instructions.append(instruction)
+                if inst == 'COPY':
+                    m = COPY_FROM_REGEX.search(params)
+                    if m:
+                        source = self.get(m.group(1))
+                        # Otherwise it is copying out of an image
+                        if source is not None:
+                            stage.copies_from.append(source)
+
+    def get(self, ref):
+        """
+        The stage called `ref` (by name or index) defined so far, None if `ref` is an image
+        """
+        stage = self._names.get(ref.lower())
+        if stage is None and ref.isdigit() and int(ref) < len(self.stages):
+            stage = self.stages[int(ref)]
+        return stage
+
+    def target(self, target=None):
+        if target is None:
+            return self.stages[-1] if self.stages else None
+        stage = self.get(target)
+        if stage is None:
+            raise ValueError("There is no stage `{target}`".format(target=target))
+        return stage
+
+    def chain(self, target=None):
+        """
+        The stages `target` is built on, from the one built from an image
+        down to `target`. Their instructions all end up in the one image.
+        """
+        chain = []
+        stage = self.target(target)
+        while stage is not None:
+            chain.append(stage)
+            stage = stage.parent
+        chain.reverse()
+        return chain
+
+    def reachable(self, target=None):
+        """
+        Every stage `target` needs, following FROM and `COPY --from=`
+        """
+        stage = self.target(target)
+        if stage is None:
+            return []
+        seen = {stage.index}
+        todo = [stage]
+        while todo:
+            stage = todo.pop()
+            for needed in [stage.parent, *stage.copies_from]:
+                if needed is not None and needed.index not in seen:
+                    seen.add(needed.index)
+                    todo.append(needed)
+        return [stage for stage in self.stages if stage.index in seen]
+
+    def get_instructions(self, target=None):
+        """
+        Yield the instructions that go into the image: the preamble and the
+        stages in the chain of `target`.
+
+        Stages that are only used by `COPY --from=` are not run, what they
+        made is gotten out of the image along with everything else ADDed or
+        COPYed. Stages that are not needed at all are skipped entirely.
+        """
+        yield from self.preamble
+        chain = self.chain(target)
+        reachable = {stage.index for stage in self.reachable(target)}
+        for stage in self.stages:
+            if stage in chain:
+                yield from stage.instructions
+            elif stage.index in reachable:
+                logging.debug("Not running %r, its files are copied out of the image", stage)
+            else:
+                logging.debug("Skipping %r, nothing uses it", stage)
@@ -0,0 +1,161 @@
+"""
+Content addressed store for files gotten out of images by ADD and COPY
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import extract
+    import tracing
+except ModuleNotFoundError:
+    import monolith.extract as extract
+    import monolith.tracing as tracing
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_STORE_DIR = os.environ.get('MONOLITH_STORE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'monolith', 'artifacts'))
+FICLONE = 0x40049409  # From linux/fs.h
+
+
+def reflink(src, dst):
+    """
+    Make `dst` a copy on write clone of `src`, only works on some filesystems
+    """
+    if fcntl is None:
+        raise OSError("reflinks are not supported here")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class ArtifactStore:
+    """
+    Files are stored once by their sha256 under `blobs/`, `index.json` maps
+    `<image digest>:<path>` to the sha256 of the file at `path` in that image,
+    or None if there is no file there.
+
+    Since an image digest never changes what it points to, once a path is in
+    the index it never has to be extracted again.
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, folder=DEFAULT_STORE_DIR):
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.folder, self.INDEX_NAME)) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.folder, self.INDEX_NAME))
+
+    @staticmethod
+    def key(digest, path):
+        return '{digest}:{path}'.format(digest=digest, path=path)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.folder, 'blobs', sha256)
+
+    def add(self, digest, path, extracted):
+        """
+        Move an `ExtractedFile` into the store, or record that there is nothing at `path`
+        """
+        with self._lock:
+            sha256 = None
+            if extracted is not None:
+                sha256 = extracted.sha256
+                blob = self.blob_path(sha256)
+                if os.path.exists(blob):
+                    # Already have the same content
+                    os.remove(extracted.filename)
+                else:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    shutil.move(extracted.filename, blob)
+            self.index[self.key(digest, path)] = sha256
+
+    def materialize(self, sha256, filename):
+        """
+        Put the blob at `filename`, hardlinking or reflinking when possible
+        """
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        if os.path.lexists(filename):
+            os.remove(filename)
+        blob = self.blob_path(sha256)
+        try:
+            os.link(blob, filename)
+            return
+        except OSError:
+            pass
+        try:
+            reflink(blob, filename)
+            shutil.copymode(blob, filename)
+            return
+        except OSError:
+            pass
+        shutil.copy2(blob, filename)
+
+    def get_files(self, extractor, image, paths, folder):
+        """
+        Put each of `paths` from `image` into `folder`, under the same path
+        they have in the image. Only the paths the store has not seen yet for
+        this image are extracted with `extractor`.
+
+        Returns a dict of path -> local filename, or None for paths that are
+        missing or are not regular files
+        """
+        digest = extractor.digest(image)
+        with self._lock:
+            missing = [path for path in paths if self.key(digest, path) not in self.index]
+        self.hits += len(paths) - len(missing)
+        self.misses += len(missing)
+        tracing.count('artifact_store_hits', len(paths) - len(missing))
+        tracing.count('artifact_store_misses', len(missing))
+
+        if missing:
+            logging.debug("Extracting %s from `%s`", missing, image)
+            os.makedirs(self.folder, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.folder)
+            try:
+                extracted = extractor.extract(image, missing, tmp)
+                with self._lock:
+                    for path in missing:
+                        self.add(digest, path, extracted[path])
+                    self._save_index()
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        local = {}
+        for path in paths:
+            sha256 = self.index[self.key(digest, path)]
+            if sha256 is None:
+                local[path] = None
+                continue
+            local[path] = extract.local_path(folder, path)
+            self.materialize(sha256, local[path])
+        return local
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.index)}
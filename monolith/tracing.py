@@ -0,0 +1,74 @@
+"""
+Record where time goes as spans and counters, and export them in the Chrome
+trace format (load the file in chrome://tracing or https://ui.perfetto.dev)
+
+Tracing is off until `tracer.enabled` is set, when it is off `span` and
+`count` do almost nothing.
+
+    with tracing.span('get_dockerfile', image=name):
+        ...
+    tracing.count('bytes_fetched', len(body))
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def _now(self):
+        # Chrome traces are in microseconds
+        return (time.perf_counter() - self._start) * 1e6
+
+    @contextlib.contextmanager
+    def span(self, name, category='monolith', **args):
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': self._now() - start,
+                     'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            self.events.append({'name': name, 'ph': 'C', 'ts': self._now(), 'pid': os.getpid(),
+                                'args': {name: self.counters[name]}})
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+            self.counters = {}
+
+    def export(self, fp):
+        """
+        Write the trace to `fp`, a file object or a filename
+        """
+        if not hasattr(fp, 'write'):
+            with open(fp, 'w') as f:
+                return self.export(f)
+        with self._lock:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'counters': self.counters}}, fp)
+
+
+# The tracer everything in monolith records to
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
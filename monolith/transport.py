@@ -0,0 +1,255 @@
+"""
+Shared HTTP transport for talking to dockerhub and docker registries
+
+All requests go through one pooled `requests.Session` so connections are kept
+alive between calls. Each host can be given a token bucket rate limit, 429s
+wait for `Retry-After` and 5xx responses are retried with jittered exponential
+backoff. `Transport.request_async` does the same for the asyncio api.
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+try:
+    import tracing
+except ModuleNotFoundError:
+    import monolith.tracing as tracing
+
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average with bursts of up to `burst`
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def _take(self):
+        """
+        Take a token, returns None if there was one or how long to wait for one
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        """
+        wait = self._take()
+        while wait is not None:
+            time.sleep(wait)
+            wait = self._take()
+
+    async def acquire_async(self):
+        """
+        The same as `acquire` without blocking the event loop
+        """
+        wait = self._take()
+        while wait is not None:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+    def pause(self, seconds):
+        """
+        Empty the bucket so nothing goes out for `seconds`, used for `Retry-After`
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def parse_retry_after(value):
+    """
+    `Retry-After` is either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class Transport:
+    def __init__(self, pool_size=32, max_retries=5, backoff=0.5, max_backoff=60, timeout=30):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.rate_limits = {}
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+
+    def set_rate_limit(self, host, rate, burst=1):
+        """
+        Limit requests to `host` to `rate` per second
+        """
+        self.rate_limits[host] = TokenBucket(rate, burst)
+
+    def _backoff(self, attempt):
+        # Full jitter, https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _count(self, name, amount):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def _retry_wait(self, url, attempt, bucket, status=None, headers=None):
+        """
+        How long to wait before trying again, or None to not try again.
+        `status` is None if the connection failed.
+        """
+        if attempt >= self.max_retries:
+            return None
+        if status is None:
+            wait = self._backoff(attempt)
+            logging.debug("Connection error for {url}, retrying in {wait:.2f}s".format(url=url, wait=wait))
+        elif status == 429:
+            self._count('throttled', 1)
+            wait = parse_retry_after(headers.get('Retry-After'))
+            if wait is None:
+                wait = self._backoff(attempt)
+            logging.warning("Rate limited by {url}, waiting {wait:.2f}s".format(url=url, wait=wait))
+            if bucket is not None:
+                # Hold back everyone else going to this host as well
+                bucket.pause(wait)
+        elif status in RETRY_STATUS_CODES:
+            wait = self._backoff(attempt)
+            logging.debug("Got {code} for {url}, retrying in {wait:.2f}s".format(code=status, url=url, wait=wait))
+        else:
+            return None
+        self._count('retries', 1)
+        return wait
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self.rate_limits.get(urllib.parse.urlsplit(url).hostname)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                self._count('queued', 1)
+                try:
+                    bucket.acquire()
+                finally:
+                    self._count('queued', -1)
+
+            self._count('in_flight', 1)
+            self._count('requests', 1)
+            try:
+                with tracing.span(method, category='http', url=url):
+                    response = self.session.request(method, url, **kwargs)
+                if not kwargs.get('stream'):
+                    tracing.count('bytes_fetched', len(response.content))
+            except requests.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            finally:
+                self._count('in_flight', -1)
+
+            if response is None:
+                wait = self._retry_wait(url, attempt, bucket)
+            else:
+                wait = self._retry_wait(url, attempt, bucket, response.status_code, response.headers)
+                if wait is None:
+                    return response
+                # Give the connection back to the pool instead of holding it while we wait
+                response.close()
+            attempt += 1
+            time.sleep(wait)
+
+    async def request_async(self, session, method, url, **kwargs):
+        """
+        The same as `request` with an `aiohttp.ClientSession`, sharing the
+        rate limits, retries and counts. The body is read before the response
+        is returned.
+        """
+        import aiohttp  # Only needed for the async api
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(total=self.timeout))
+        bucket = self.rate_limits.get(urllib.parse.urlsplit(url).hostname)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                self._count('queued', 1)
+                try:
+                    await bucket.acquire_async()
+                finally:
+                    self._count('queued', -1)
+
+            self._count('in_flight', 1)
+            self._count('requests', 1)
+            try:
+                with tracing.span(method, category='http', url=url):
+                    response = await session.request(method, url, **kwargs)
+                    try:
+                        body = await response.read()
+                    finally:
+                        response.release()
+                tracing.count('bytes_fetched', len(body))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            finally:
+                self._count('in_flight', -1)
+
+            if response is None:
+                wait = self._retry_wait(url, attempt, bucket)
+            else:
+                wait = self._retry_wait(url, attempt, bucket, response.status, response.headers)
+                if wait is None:
+                    return response
+            attempt += 1
+            await asyncio.sleep(wait)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def metrics(self):
+        return {'in_flight': self.in_flight,
+                'queued': self.queued,
+                'requests': self.requests,
+                'retries': self.retries,
+                'throttled': self.throttled}
+
+
+# The transport used by everything in monolith unless told otherwise
+default_transport = Transport()
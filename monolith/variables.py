@@ -0,0 +1,102 @@
+"""
+Substitute ARG and ENV variables into the params of an instruction
+
+Supports `$VAR`, `${VAR}`, `${VAR:-default}` and `${VAR:+alternative}`.
+Everything is done in one pass over the text, so the cost does not depend on
+how many variables there are.
+
+ENV, ARG and LABEL values are words of their own, see `expand_word`.
+"""
+import re
+
+# `\` escapes and single quoted text are matched so they can be left alone
+VARIABLE_REGEX = re.compile(r"""\\.|'[^']*'|\$(?:\{(\w+)(?::([-+])((?:[^{}]|\{[^{}]*\})*))?\}|(\w+))""")
+# The quoted and unquoted parts of a word
+WORD_PART_REGEX = re.compile(r"""\\.|'[^']*'|"(?:[^"\\]|\\.)*"|[^\\'"]+|.""", re.DOTALL)
+# Anything the shell would do something with
+UNSAFE_REGEX = re.compile(r'[^\w@%+=:,./-]')
+
+
+def literal(word):
+    """
+    What a shell word means once its quotes and escapes are taken out
+    """
+    parts = []
+    for m in WORD_PART_REGEX.finditer(word):
+        part = m.group(0)
+        if part[0] == '\\':
+            parts.append(part[1:])
+        elif part[0] == "'" and len(part) > 1:
+            parts.append(part[1:-1])
+        elif part[0] == '"' and len(part) > 1:
+            parts.append(re.sub(r'\\([\\"$`])', r'\1', part[1:-1]))
+        else:
+            parts.append(part)
+    return ''.join(parts)
+
+
+def quote(value):
+    """
+    `value` as part of a shell word, in double quotes if it needs them
+    """
+    if not UNSAFE_REGEX.search(value):
+        return value
+    return '"' + escape(value) + '"'
+
+
+def escape(value):
+    """
+    `value` as part of a double quoted string
+    """
+    return re.sub(r'([\\"$`])', r'\\\1', value)
+
+
+def expand(text, variables, quote=None):
+    """
+    Replace the variables in `text` with their values in `variables`
+
+    A variable that is not in `variables` is left as it is, so a shell can
+    still fill it in later (`$PATH` for example). `quote` is applied to each
+    value that is put in.
+    """
+    if '$' not in text:
+        return text
+
+    def replace(m):
+        name = m.group(1) or m.group(4)
+        if name is None:
+            return m.group(0)
+        value = variables.get(name)
+        modifier = m.group(2)
+        if modifier == '-':
+            return quote_value(value) if value else expand(m.group(3), variables, quote)
+        elif modifier == '+':
+            return expand(m.group(3), variables, quote) if value else ''
+        return m.group(0) if value is None else quote_value(value)
+
+    def quote_value(value):
+        return quote(value) if quote else value
+
+    return VARIABLE_REGEX.sub(replace, text)
+
+
+def expand_word(word, variables):
+    """
+    `expand` for a single shell word, like the value in `ENV KEY=value`
+
+    Docker splits the params into words before it substitutes anything, so
+    a value with spaces in it stays part of the one word. The values put in
+    are quoted so the word still means the same thing to a shell.
+    """
+    if '$' not in word:
+        return word
+    parts = []
+    for m in WORD_PART_REGEX.finditer(word):
+        part = m.group(0)
+        if part[0] == '"':
+            parts.append('"' + expand(part[1:-1], variables, escape) + '"')
+        elif part[0] in '\\\'':
+            parts.append(part)
+        else:
+            parts.append(expand(part, variables, quote))
+    return ''.join(parts)
@@ -6,4 +6,5 @@ setuptools.setup(
     packages=['monolith'],
     scripts=['scripts/monolith'],
     install_requires=['requests>=2.21'],
+    extras_require={'async': ['aiohttp>=3.5']},
 )
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# The stand in for Docker Hub and the registry lives with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import fakehub  # noqa: E402
+
+
+@pytest.fixture
+def hub():
+    with fakehub.FakeHub() as hub:
+        yield hub
@@ -0,0 +1,38 @@
+"""
+The dockerfile cache, see `monolith.cache`
+"""
+import os
+import threading
+
+from monolith.cache import DockerfileCache
+
+
+def test_read_does_not_write_the_index(tmp_path):
+    cache = DockerfileCache(str(tmp_path))
+    cache.put('a/b:latest', 'FROM c')
+    index = os.path.join(str(tmp_path), DockerfileCache.INDEX_NAME)
+    os.utime(index, ns=(0, 0))
+
+    assert cache.read('a/b:latest') == 'FROM c'
+    assert os.stat(index).st_mtime_ns == 0
+    accessed = cache.index['a/b:latest']['accessed']
+
+    cache.flush()
+    assert os.stat(index).st_mtime_ns != 0
+    assert DockerfileCache(str(tmp_path)).index['a/b:latest']['accessed'] == accessed
+
+
+def test_lookup_counts_under_the_lock(tmp_path):
+    cache = DockerfileCache(str(tmp_path))
+    cache.put('a/b:latest', 'FROM c')
+
+    def look():
+        for _ in range(1000):
+            cache.lookup('a/b:latest')
+            cache.lookup('a/c:latest')
+    threads = [threading.Thread(target=look) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.hits == cache.misses == 8000
@@ -0,0 +1,230 @@
+"""
+Getting files out of images, see `monolith.extract`
+"""
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import monolith.extract as extract
+import monolith.store as store
+
+# Acts like `docker` for the files under $STUB_DOCKER_ROOT, and logs its calls to $STUB_DOCKER_LOG
+STUB_DOCKER = '''#!{python}
+import os, sys, tarfile
+root = os.environ['STUB_DOCKER_ROOT']
+with open(os.environ['STUB_DOCKER_LOG'], 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+fail = os.environ.get('STUB_DOCKER_FAIL', '')
+if sys.argv[1] in fail.split(','):
+    sys.stderr.write('Cannot connect to the Docker daemon\\n')
+    sys.exit(1)
+if sys.argv[1] == 'create':
+    print('container')
+elif sys.argv[1] == 'image':
+    print('sha256:image')
+elif sys.argv[1] == 'cp':
+    path = sys.argv[2].split(':', 1)[1]
+    local = os.path.join(root, os.path.normpath('/' + path).lstrip('/'))
+    if not os.path.lexists(local):
+        sys.stderr.write('Error: No such container:path: {{}}\\n'.format(sys.argv[2]))
+        sys.exit(1)
+    with tarfile.open(fileobj=sys.stdout.buffer, mode='w|') as tar:
+        tar.add(local, arcname=os.path.basename(path))
+'''
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    """
+    A stub `docker` first on PATH, returns the folder its image files go in
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'docker'
+    stub.write_text(STUB_DOCKER.format(python=sys.executable))
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    root = tmp_path / 'image'
+    root.mkdir()
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('STUB_DOCKER_ROOT', str(root))
+    monkeypatch.setenv('STUB_DOCKER_LOG', str(tmp_path / 'calls.log'))
+    monkeypatch.delenv('STUB_DOCKER_FAIL', raising=False)
+    return root
+
+
+def test_copy(docker, tmp_path):
+    (docker / 'etc').mkdir()
+    (docker / 'etc' / 'a.conf').write_text('a')
+    extracted = extract.DockerExtractor().extract('image', ['/etc/a.conf', '/etc', '/missing'], str(tmp_path / 'out'))
+    assert extracted['/etc/a.conf'].size == 1
+    with open(extracted['/etc/a.conf'].filename) as f:
+        assert f.read() == 'a'
+    assert extracted['/etc'] is None
+    assert extracted['/missing'] is None
+
+
+def test_copy_failure_is_raised_and_not_stored(docker, tmp_path, monkeypatch):
+    (docker / 'a').write_text('a')
+    artifact_store = store.ArtifactStore(str(tmp_path / 'store'))
+    monkeypatch.setenv('STUB_DOCKER_FAIL', 'cp')
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        artifact_store.get_files(extract.DockerExtractor(), 'image', ['/a'], str(tmp_path / 'out'))
+    assert 'Cannot connect' in e.value.stderr
+    assert artifact_store.index == {}
+
+    monkeypatch.delenv('STUB_DOCKER_FAIL')
+    files = artifact_store.get_files(extract.DockerExtractor(), 'image', ['/a'], str(tmp_path / 'out'))
+    assert files['/a'] == str(tmp_path / 'out' / 'a')
+
+
+def calls(docker):
+    with open(os.path.join(os.path.dirname(str(docker)), 'calls.log')) as f:
+        return [line.split()[0] for line in f]
+
+
+def test_failed_pull_is_tried_again(docker, monkeypatch):
+    extractor = extract.DockerExtractor()
+    monkeypatch.setenv('STUB_DOCKER_FAIL', 'pull')
+    with pytest.raises(subprocess.CalledProcessError):
+        extractor.pull('image')
+    assert 'image' not in extractor.pulled
+
+    monkeypatch.delenv('STUB_DOCKER_FAIL')
+    extractor.pull('image')
+    extractor.pull('image')
+    assert 'image' in extractor.pulled
+    assert calls(docker) == ['pull', 'pull']
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason="Needs /proc to measure memory")
+def test_memory_stays_flat_for_large_files(docker, tmp_path):
+    size = 128 * 1024 * 1024
+    with open(str(docker / 'large'), 'wb') as f:
+        f.truncate(size)
+    peak = []
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak.append(rss())
+            time.sleep(0.001)
+
+    extractor = extract.DockerExtractor(chunk_size=1024 * 1024)
+    before = rss()
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        extracted = extractor.extract('image', ['/large'], str(tmp_path / 'out'))
+    finally:
+        done.set()
+        sampler.join()
+    assert extracted['/large'].size == size
+    assert max(peak) - before < 32 * 1024 * 1024
+
+
+def layer(files):
+    """
+    A gzipped layer tar of `files`, name -> bytes
+    """
+    import gzip
+    import io
+    import tarfile
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in files.items():
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+    return gzip.compress(data.getvalue())
+
+
+@pytest.fixture
+def registry(hub, monkeypatch):
+    """
+    Puts an image made of layers (oldest first) in the fake registry, the
+    blobs that are gotten are in `registry.fetched`
+    """
+    import hashlib
+    import monolith.registry
+
+    def push(name, *layers):
+        digests = []
+        for files in layers:
+            blob = layer(files)
+            digests.append('sha256:' + hashlib.sha256(blob).hexdigest())
+            hub.blobs[('library/' + name, digests[-1])] = blob
+        manifest = {'mediaType': monolith.registry.MANIFEST_V2,
+                    'config': {'digest': 'sha256:config'},
+                    'layers': [{'digest': digest} for digest in digests]}
+        hub.manifests[('library/' + name, 'latest')] = (monolith.registry.MANIFEST_V2, manifest)
+        return digests
+
+    registry = monolith.registry.Registry(hub.url + '/v2/')
+    registry.push = push
+    registry.fetched = []
+    get_blob = registry.get_blob
+
+    def fetch(repository, digest, stream=False):
+        registry.fetched.append(digest)
+        return get_blob(repository, digest, stream=stream)
+    monkeypatch.setattr(registry, 'get_blob', fetch)
+    return registry
+
+
+def read(extracted):
+    with open(extracted.filename, 'rb') as f:
+        return f.read()
+
+
+def test_registry_newest_layer_wins_and_stops_early(registry, tmp_path):
+    bottom, middle, top = registry.push('image', {'etc/a': b'old', 'etc/b': b'b'}, {'etc/a': b'new'}, {'etc/c': b'c'})
+    extracted = extract.RegistryExtractor(registry).extract('image', ['/etc/a'], str(tmp_path))
+    assert read(extracted['/etc/a']) == b'new'
+    # Found in the middle layer, the bottom one is never downloaded
+    assert registry.fetched == [top, middle]
+
+
+def test_registry_whiteouts(registry, tmp_path):
+    registry.push('image',
+                  {'etc/a': b'a', 'etc/b': b'b', 'opt/x/f': b'f'},
+                  {'etc/.wh.a': b'', 'opt/x/.wh..wh..opq': b'', 'opt/x/g': b'g'})
+    extracted = extract.RegistryExtractor(registry).extract('image', ['/etc/a', '/etc/b', '/opt/x/f', '/opt/x/g', '/missing'],
+                                                            str(tmp_path))
+    assert extracted['/etc/a'] is None
+    assert read(extracted['/etc/b']) == b'b'
+    assert extracted['/opt/x/f'] is None
+    assert read(extracted['/opt/x/g']) == b'g'
+    assert extracted['/missing'] is None
+    assert len(registry.fetched) == 2
+
+
+def test_paths_stay_in_the_folder(docker, tmp_path):
+    folder = str(tmp_path / 'out')
+    assert extract.local_path(folder, '/../../escaped/x') == os.path.join(folder, 'escaped', 'x')
+    assert extract.local_path(folder, '//etc/../x') == os.path.join(folder, 'x')
+
+    (docker / 'x').write_text('x')
+    (docker / 'x').chmod(0o4755)
+    artifact_store = store.ArtifactStore(str(tmp_path / 'store'))
+    files = artifact_store.get_files(extract.DockerExtractor(), 'image', ['/../../x'], folder)
+    assert files['/../../x'] == os.path.join(folder, 'x')
+    assert not (tmp_path / 'x').exists()
+    # No setuid from the image
+    assert os.stat(files['/../../x']).st_mode & 0o7777 == 0o755
+
+
+def test_copy_destination_is_normalized():
+    import monolith.parsers as parsers
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse('FROM ubuntu\nCOPY x /../../escaped/x\nWORKDIR /app\nCOPY a b ./\n')
+    assert m._pending_files == [(['x'], '/escaped/x'), (['a', 'b'], '/app/')]
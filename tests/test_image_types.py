@@ -0,0 +1,107 @@
+"""
+Getting lineages from dockerhub, see `monolith.image_types`
+"""
+import asyncio
+import threading
+
+import pytest
+
+import monolith.cache as cache
+import monolith.image_types as image_types
+import monolith.index as index
+from monolith.image_types import DockerImage
+
+
+@pytest.fixture
+def images(hub, tmp_path, monkeypatch):
+    """
+    DockerImage getting dockerfiles from the fake hub, with a cache and an index on disk
+    """
+    hub.dockerfiles.update({('a', 'app'): 'FROM a/base:1\nRUN make\n',
+                            ('a', 'other'): 'FROM a/base:1\nRUN true\n',
+                            ('a', 'base'): 'FROM ubuntu\n',
+                            ('_', 'ubuntu'): 'FROM scratch\n'})
+    monkeypatch.setattr(image_types, 'DOCKERFILE_URL', hub.url + '/v2/repositories/{user}/{image}/dockerfile/')
+    monkeypatch.setattr(DockerImage, 'dockerfile_cache', cache.DockerfileCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(DockerImage, 'lineage_index', index.LineageIndex(str(tmp_path / 'lineage.db')))
+    return DockerImage
+
+
+def test_get_forest_async_keeps_disk_off_the_loop(images, monkeypatch):
+    pytest.importorskip('aiohttp')
+    loop_threads = set()
+    blocked = []
+
+    def off_the_loop(method):
+        def wrapper(*args, **kwargs):
+            if threading.current_thread() in loop_threads:
+                blocked.append(method.__name__)
+            return method(*args, **kwargs)
+        return wrapper
+    for cls, name in [(cache.DockerfileCache, 'get'), (cache.DockerfileCache, 'read'),
+                      (cache.DockerfileCache, 'put'), (index.LineageIndex, 'record')]:
+        monkeypatch.setattr(cls, name, off_the_loop(getattr(cls, name)))
+
+    async def get_forest(names):
+        loop_threads.add(threading.current_thread())
+        return await images.get_forest_async(names)
+
+    loop = asyncio.new_event_loop()
+    try:
+        # Once from the hub and once from the cache
+        for _ in range(2):
+            forest = loop.run_until_complete(get_forest(['a/app', 'a/other']))
+            assert [image.name for image in forest['a/app'].get_lineage()] [-3:] == ['ubuntu:latest', 'a/base:1', 'a/app']
+            assert forest['a/app'].parent is forest['a/other'].parent
+    finally:
+        loop.close()
+    assert blocked == []
+    assert len(images.lineage_index) == 5
+    assert images.dockerfile_cache.hits == 5
+
+
+def test_children_can_be_added_to():
+    base, app, other = DockerImage('a/base'), DockerImage('a/app'), DockerImage('a/other')
+    assert dict(base.children) == {}
+    base.children[app.name] = app
+    base.add_child(other)
+    assert base.children == {'a/app': app, 'a/other': other}
+    del base.children['a/app']
+    assert list(base.children) == ['a/other']
+
+    base.children = {}
+    assert len(base.children) == 0
+    assert 'a/other' not in base.children
+
+
+def test_get_dockerfile_async_looks_in_the_cache_once(images):
+    pytest.importorskip('aiohttp')
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(images.get_dockerfile_async('a/app')) == 'FROM a/base:1\nRUN make\n'
+    finally:
+        loop.close()
+    assert (images.dockerfile_cache.hits, images.dockerfile_cache.misses) == (0, 1)
+
+
+def test_get_forest_async_is_retried(images, hub, monkeypatch):
+    pytest.importorskip('aiohttp')
+    import monolith.transport as transport
+    monkeypatch.setattr(DockerImage, 'http', transport.Transport(backoff=0))
+    hub.failures.extend([429, 503])
+    loop = asyncio.new_event_loop()
+    try:
+        forest = loop.run_until_complete(images.get_forest_async(['a/app']))
+    finally:
+        loop.close()
+    assert forest['a/app'].get_lineage()[-2].name == 'a/base:1'
+    assert images.http.metrics()['retries'] == 2
+    assert images.http.metrics()['throttled'] == 1
+
+
+def test_failure_without_a_cached_copy_raises(images, hub, monkeypatch):
+    import monolith.transport as transport
+    monkeypatch.setattr(DockerImage, 'http', transport.Transport(max_retries=1, backoff=0))
+    hub.failures.extend([503, 503])
+    with pytest.raises(image_types.DockerHubError):
+        images.get_dockerfile('a/app')
@@ -0,0 +1,33 @@
+"""
+The lineage index, see `monolith.index`
+"""
+from monolith.index import LineageIndex
+
+
+def keys(entries):
+    return [entry['key'] for entry in entries]
+
+
+def index(*edges):
+    lineage_index = LineageIndex(':memory:')
+    for key, parent in edges:
+        lineage_index.record(key, key, parent, parent, 'FROM {}'.format(parent))
+    return lineage_index
+
+
+def test_ancestors_and_descendants():
+    lineage_index = index(('a/c:1', 'a/b:1'), ('a/b:1', 'a/a:1'), ('a/a:1', None), ('a/d:1', 'a/b:1'))
+    assert keys(lineage_index.ancestors('a/c:1')) == ['a/b:1', 'a/a:1']
+    assert keys(lineage_index.descendants('a/a:1')) == ['a/b:1', 'a/c:1', 'a/d:1']
+
+
+def test_self_edge_does_not_hang():
+    lineage_index = index(('a/b:1', 'a/b:1'))
+    assert keys(lineage_index.ancestors('a/b:1')) == []
+    assert keys(lineage_index.descendants('a/b:1')) == []
+
+
+def test_cycle_does_not_hang():
+    lineage_index = index(('a/b:1', 'a/c:1'), ('a/c:1', 'a/b:1'))
+    assert keys(lineage_index.ancestors('a/b:1')) == ['a/c:1']
+    assert keys(lineage_index.descendants('a/b:1')) == ['a/c:1']
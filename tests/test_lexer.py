@@ -0,0 +1,64 @@
+"""
+Splitting dockerfiles into instructions, see `monolith.lexer`
+"""
+import random
+
+import monolith.lexer as lexer
+import monolith.parsers as parsers
+
+
+def tokens(code):
+    return [(inst, params) for inst, params, _, _ in lexer.tokenize(code)]
+
+
+def test_heredoc():
+    code = 'RUN cat <<EOF > /a\nFROM x\nEOF\nRUN echo done\n'
+    assert tokens(code) == [('RUN', 'cat <<EOF > /a\nFROM x\nEOF\n'), ('RUN', 'echo done\n')]
+
+
+def test_not_heredocs():
+    code = 'RUN cat <<<word\nRUN echo $((1<<FOO))\nENV A=<<EOF\nRUN echo done\n'
+    assert [inst for inst, _ in tokens(code)] == ['RUN', 'RUN', 'ENV', 'RUN']
+
+
+def test_quoted_heredocs():
+    code = 'RUN echo "see <<EOF for details" \'<<EOF\' \\<<EOF\nRUN echo "a \\\n  <<EOF"\nENV A=1\nRUN cat <<"EOF"\nx\nEOF\n'
+    assert [inst for inst, _ in tokens(code)] == ['RUN', 'RUN', 'ENV', 'RUN']
+    assert tokens(code)[-1][1] == 'cat <<"EOF"\nx\nEOF\n'
+
+
+def test_escape_directive():
+    code = '# escape=`\nENV A=C:\\foo `\n    B="x `"y"\nRUN echo a && `\n    echo b\n'
+    assert tokens(code) == [('ENV', 'A=C:\\\\foo \\\n    B="x \\"y"\n'), ('RUN', 'echo a && \\\n    echo b\n')]
+
+
+def test_escape_directive_in_post():
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse('# escape=`\nFROM ubuntu\nENV A=C:\\foo\nRUN echo a && `\n    echo b\n')
+    post = ''.join(m.post)
+    assert 'export A=C:\\\\foo' in post
+    assert 'echo a && \\\n' in post
+    assert '`' not in post
+
+
+# Pieces that have tripped up the lexer, put together at random
+PIECES = ['\nRUN ', '\nENV ', '\nCOPY ', '\nLABEL ', 'FROM x\n', '# escape=`\n', '# c\n', '\\', '`', '\n', ' ', '\t', '\r\n',
+          '<<EOF', '<<-"EOF"', '<<<', '"x <<EOF"', "'<<EOF'", 'EOF', '\tEOF', '$((1<<2))', '"', "'", 'a=b', '${A:-x}', '\\\n']
+
+
+def test_fuzz():
+    rng = random.Random(0)
+    for _ in range(2000):
+        code = ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+        lines = code.count('\n') + 1
+        last = 0
+        for inst, params, first_line, last_line in lexer.tokenize(code):
+            assert last < first_line <= last_line <= lines
+            assert params.endswith('\n')
+            last = last_line
+        m = parsers.DockerFileToSingularityFile(None)
+        try:
+            m.parse(code)
+        except Exception as e:
+            # Bad input is fine, as long as it is reported as such
+            assert str(e).startswith('Malformed params'), (code, e)
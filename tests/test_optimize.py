@@ -0,0 +1,41 @@
+"""
+The %post optimizer, see `monolith.optimize`
+"""
+import monolith.optimize as optimize
+from monolith.optimize import RunCommand
+
+
+def optimized(*runs):
+    post, report = optimize.optimize_post([RunCommand(run) for run in runs])
+    return ''.join(post), report
+
+
+def test_pip_installs_are_merged():
+    post, report = optimized('pip install numpy', 'pip install scipy')
+    assert 'pip install numpy scipy' in post
+    assert report['pip_installs_merged'] == 1
+
+
+def test_pip_installs_of_different_versions_are_not_merged():
+    post, report = optimized('pip install numpy==1.0', 'pip install numpy==2.0 scipy')
+    assert 'pip install numpy==1.0 && ' in post
+    assert 'pip install numpy==2.0 scipy' in post
+    assert post.index('numpy==1.0') < post.index('numpy==2.0')
+
+
+def test_apt_get_clean_is_kept():
+    post, report = optimized('apt-get update && apt-get install -y a && apt-get clean && rm -rf /var/lib/apt/lists/*',
+                             'apt-get update && apt-get install -y b && apt-get clean')
+    assert 'apt-get install -y a b' in post
+    assert post.count('apt-get clean') == 1
+    assert post.count('rm -rf /var/lib/apt/lists/*') == 1
+    assert post.index('apt-get clean') > post.index('apt-get install')
+
+
+def test_pip_installs_for_different_interpreters_are_kept():
+    post, report = optimized('pip install numpy', 'pip3 install numpy', 'python3 -m pip install numpy', 'pip3 install numpy')
+    assert 'pip install numpy' in post
+    assert 'pip3 install numpy' in post
+    assert 'python3 -m pip install numpy' in post
+    assert post.count('pip3 install numpy') == 1
+    assert report['pip_installs_merged'] == 1
@@ -0,0 +1,46 @@
+"""
+Dockerfiles and image configs to Singularity files, see `monolith.parsers`
+"""
+import monolith.parsers as parsers
+
+
+def runscript(m):
+    singularity = m.singularity_file()
+    return singularity[singularity.index('%runscript'):singularity.index('%test')]
+
+
+def test_workdir_from_image_config():
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse_image_config({'config': {'WorkingDir': '/my app', 'Cmd': ['python', 'x.py']}})
+    assert "cd '/my app'\n" in runscript(m)
+
+
+def test_workdir_from_dockerfile():
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse('FROM ubuntu\nWORKDIR /root\nWORKDIR caffe\n')
+    assert 'cd /root/caffe\n' in runscript(m)
+
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse('FROM ubuntu\n')
+    assert 'cd' not in runscript(m)
+
+
+def test_copy_heredoc_is_written_in_post():
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse('FROM ubuntu\nCOPY <<EOF /app/x\nhello $HOME\nEOF\nCOPY <<-"A" <<B /etc/\n\tone\n\tA\ntwo\nB\nRUN echo done\n')
+    post = ''.join(m.post)
+    assert 'cat > /app/x <<EOF\nhello $HOME\nEOF' in post
+    assert "cat > /etc/A <<'A'\none\nA" in post
+    assert 'cat > /etc/B <<B\ntwo\nB' in post
+    assert 'echo done' in post
+    # Nothing to get out of the image
+    assert m._pending_files == []
+
+
+def test_copy_heredoc_converted_offline():
+    import monolith.convert as convert
+    singularity = convert.convert('FROM ubuntu\nCOPY <<EOF /app/x\nhello\nEOF\n')
+    files = singularity[singularity.index('%files'):singularity.index('%labels')]
+    assert 'EOF' not in files and 'hello' not in files
+    assert 'cat > /app/x <<EOF\nhello\nEOF' in singularity
+    assert '$SINGULARITY_ROOTFS/EOF' not in singularity
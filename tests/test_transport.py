@@ -0,0 +1,41 @@
+"""
+Retries and rate limits, see `monolith.transport`
+"""
+from monolith.transport import Transport
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b''
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Session:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def request(self, method, url, **kwargs):
+        self.sent.append(self.responses.pop(0))
+        return self.sent[-1]
+
+
+def test_retried_responses_are_closed():
+    transport = Transport(backoff=0)
+    transport.session = Session([Response(503), Response(429, {'Retry-After': '0'}), Response(200)])
+    response = transport.get('http://hub.example/')
+    assert response.status_code == 200
+    assert [sent.closed for sent in transport.session.sent] == [True, True, False]
+    assert transport.metrics()['retries'] == 2
+    assert transport.metrics()['throttled'] == 1
+
+
+def test_last_attempt_is_returned_open():
+    transport = Transport(max_retries=1, backoff=0)
+    transport.session = Session([Response(503), Response(503)])
+    assert transport.get('http://hub.example/').closed is False
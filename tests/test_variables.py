@@ -0,0 +1,74 @@
+"""
+ARG and ENV substitution, see `monolith.variables`
+"""
+import monolith.parsers as parsers
+import monolith.variables as variables
+
+
+def parse(code):
+    m = parsers.DockerFileToSingularityFile(None)
+    m.parse(code)
+    return m
+
+
+def exports(m):
+    return [entry.strip() for entry in m.post if entry.strip().startswith('export ')]
+
+
+def test_expand_leaves_unknown_variables():
+    assert variables.expand('$PATH:${HOME}', {}) == '$PATH:${HOME}'
+    assert variables.expand('${A:-x} ${A:+y}', {}) == 'x '
+    assert variables.expand("'$A' \\$A $A", {'A': '1'}) == "'$A' \\$A 1"
+
+
+def test_expand_word_keeps_values_with_spaces_one_word():
+    values = {'B': 'two words'}
+    assert variables.expand_word('$B', values) == '"two words"'
+    assert variables.expand_word('x$B', values) == 'x"two words"'
+    assert variables.expand_word('"$B"', values) == '"two words"'
+    assert variables.expand_word("'$B'", values) == "'$B'"
+    assert variables.literal(variables.expand_word('x$B', values)) == 'xtwo words'
+
+
+def test_expand_word_escapes_what_the_shell_would_see():
+    values = {'Q': 'say "hi" $x `id`'}
+    word = variables.expand_word('$Q', values)
+    assert variables.literal(word) == values['Q']
+    assert variables.literal(variables.expand_word('"$Q"', values)) == values['Q']
+
+
+def test_env_value_with_spaces():
+    m = parse('FROM ubuntu\nENV B="two words"\nENV C=$B D=1\n')
+    assert exports(m) == ['export B="two words"', 'export C="two words"', 'export D=1']
+    assert m._variables['C'] == 'two words'
+
+
+def test_label_from_arg_with_spaces():
+    m = parse('FROM ubuntu\nARG X="a b"\nLABEL desc=$X other=1\n')
+    assert [label.strip() for label in m.labels] == ['desc "a b"', 'other 1']
+
+
+def test_env_keeps_runtime_variables():
+    m = parse('FROM ubuntu\nENV P=/opt/bin:$PATH\n')
+    assert exports(m) == ['export P=/opt/bin:$PATH']
+
+
+def test_global_arg_with_spaces():
+    m = parse('ARG X="a b"\nFROM ubuntu\nARG X\nENV Y=$X\n')
+    assert exports(m) == ['export X="a b"', 'export Y="a b"']
+
+
+def test_arg_is_exported_for_run():
+    m = parse('ARG V=1.2\nFROM ubuntu\nARG V\nARG W=x\nRUN wget http://x/v${V}.tgz\n')
+    post = ''.join(m.post)
+    assert 'export V=1.2' in post
+    assert 'export W=x' in post
+    assert post.index('export V=1.2') < post.index('wget http://x/v${V}.tgz')
+
+
+def test_arg_is_not_exported_to_the_next_image():
+    m = parse('FROM ubuntu\nARG V=1\nENV E=2\nRUN echo $V\n')
+    m.parse('FROM base\nRUN echo $V $E\n')
+    post = ''.join(m.post)
+    assert 'unset V\n' in post
+    assert 'E' not in post[post.index('unset'):].split('\n')[0]